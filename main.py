@@ -6,97 +6,1015 @@ CLI приложение для работы с нейросетями чере
 
 import os
 import sys
-import json
-from typing import List, Dict, Any, Optional
-from dotenv import load_dotenv
-import openai
-import anthropic
-from datetime import datetime
+import argparse
+import asyncio
+import functools
+import re
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+import orjson
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable, TYPE_CHECKING
+from datetime import datetime, timezone
+from collections import deque
+from types import ModuleType
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    retry_if_exception_type,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 
-# Загружаем переменные окружения
-load_dotenv()
+# Журнал ошибок приложения; трассировки выводятся только при уровне DEBUG
+log = logging.getLogger("cli")
+
+# SDK нейросетей (и httpx вместе с ними) импортируются при входе в соответствующий режим,
+# а numpy - при создании семантического кэша: их загрузка занимает сотни миллисекунд,
+# и меню не должно ее ждать
+if TYPE_CHECKING:
+    import openai
+    import anthropic
 
 # Константы
 OPENAI_BASE_URL = "https://openai.api.proxyapi.ru/v1"
 ANTHROPIC_BASE_URL = "https://api.proxyapi.ru/anthropic"
 OPENAI_MODEL = "gpt-4o-mini"
+# Модель с поддержкой веб-поиска для режима OpenAI
+OPENAI_SEARCH_MODEL = "gpt-4o-mini-search-preview"
 ANTHROPIC_MODEL = "claude-sonnet-4-5-20250929"  # Модель Claude Sonnet 4.5 (поддерживается в ProxyAPI)
+# Альтернативные названия моделей Claude, если основная не поддерживается
+ANTHROPIC_ALTERNATIVE_MODELS = [
+    "claude-sonnet-4-5-20250929",
+    "claude-sonnet-4-5-20250514",
+    "claude-sonnet-4-5",
+    "claude-3-7-sonnet-20250219",
+    "claude-3-5-sonnet-20241022"
+]
 
 # Системный промпт для поддержания диалога на русском языке
 SYSTEM_PROMPT = "Ты полезный ассистент. Веди диалог на русском языке. Отвечай подробно и по делу."
 
+# Команды выхода из чата; ввод сравнивается после casefold, поэтому подходит любой регистр
+_EXIT_TOKENS = frozenset({"exit", "quit", "q", "выход", "выйти"})
+# Ответы на вопрос "да/нет" (ввод тоже приводится через casefold)
+_YES_NO = {
+    "да": True, "д": True, "yes": True, "y": True,
+    "нет": False, "н": False, "no": False, "n": False
+}
+
+# Параметры веб-поиска. Это константы: один и тот же объект передается в каждый запрос
+# (SDK не изменяют переданные параметры).
+# Для Chat Completions API ProxyAPI используется web_search_options
+# с моделями gpt-4o-search-preview или gpt-4o-mini-search-preview
+_WEB_SEARCH_OPTS_OPENAI = {
+    "search_context_size": "medium",  # low, medium (по умолчанию), high
+    "user_location": {
+        "type": "approximate",
+        "approximate": {
+            "country": "RU",
+            "city": "Moscow",
+            "region": "Moscow"
+        }
+    }
+}
+# Для Claude веб-поиск подключается как серверный инструмент
+_ANTHROPIC_WEB_TOOL = [{
+    "type": "web_search_20250305",
+    "name": "web_search",
+    "max_uses": 5
+}]
+
+# Метка кэша промпта Anthropic: префикс запроса до помеченного блока кэшируется на сервере
+# и при следующем запросе с тем же префиксом не обрабатывается заново
+_ANTHROPIC_CACHE_CONTROL = {"type": "ephemeral"}
+
+# Промпт для сворачивания ранней части длинного диалога в краткое содержание
+SUMMARY_PROMPT = (
+    "Кратко перескажи диалог пользователя с ассистентом, сохранив важные факты, "
+    "договоренности и контекст. Пиши на русском языке."
+)
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога: "
+SUMMARY_MAX_TOKENS = 300
+# Модель, по словарю которой tiktoken считает токены истории
+TOKENIZER_MODEL = "gpt-4o-mini"
+# Средняя длина токена в символах - для оценки, если tiktoken не установлен
+CHARS_PER_TOKEN = 4
+
+# Параметры пула HTTP-соединений каждого клиента: соединения держатся открытыми между запросами,
+# чтобы не выполнять TCP/TLS рукопожатие на каждом сообщении
+HTTP_LIMITS = dict(max_connections=8, max_keepalive_connections=4, keepalive_expiry=300)
+
+# Каталог для кэшей приложения
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cli-text-ai-agent")
+# База SQLite с обоими уровнями кэша ответов (точным и семантическим)
+CACHE_DB = os.path.join(CACHE_DIR, "cache.db")
+# Время жизни записей кэша ответов (в секундах)
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+# Ответы с веб-поиском зависят от актуальных данных, поэтому живут меньше
+WEB_SEARCH_CACHE_TTL = 60 * 60
+# Мультиязычная модель эмбеддингов для семантического кэша (поддерживает русский)
+SEMANTIC_MODEL_NAME = "paraphrase-multilingual-MiniLM-L12-v2"
+# Минимальное косинусное сходство, при котором ответ берется из семантического кэша
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Пакетный режим (--batch): пауза между проверками статуса пакета растет от начальной до максимальной
+BATCH_POLL_INITIAL = 5.0
+BATCH_POLL_MAX = 60.0
+# Допустимый custom_id запроса пакета (ограничение Anthropic Message Batches)
+_BATCH_ID_RE = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+
+# Модель эмбеддингов семантического кэша: загружается один раз за запуск приложения
+# и общая для кэшей обоих режимов (SemanticCache создается заново при каждом входе в чат).
+# Загрузка идет под блокировкой: поиск, отмененный открывшимся потоком ответа, продолжает ее в своем потоке
+_semantic_model: Any = None
+_semantic_model_lock = threading.Lock()
+
+# Модель Claude, подтвержденная сервером; определяется один раз за запуск приложения
+_resolved_anthropic_model: Optional[str] = None
+# Файл с моделью Claude, подтвержденной в прошлый запуск: она проверяется первой
+ANTHROPIC_MODEL_FILE = os.path.join(CACHE_DIR, "anthropic_model.txt")
+
+
+# Прагмы баз SQLite (история и кэши): WAL (читатели не блокируют запись),
+# без fsync на каждой транзакции, небольшой кэш страниц и временные таблицы в памяти
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-2000",
+    "PRAGMA temp_store=MEMORY",
+)
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL,
+    role TEXT,
+    content TEXT,
+    mode TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_mode ON messages (mode, id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+# Кэш ответов: точные совпадения по SHA-256 ключу запроса и семантические записи
+# (эмбеддинг float32 в BLOB, запись ответа - JSON через orjson)
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, ts REAL, entry BLOB);
+CREATE TABLE IF NOT EXISTS semantic (
+    id INTEGER PRIMARY KEY,
+    mode TEXT,
+    query TEXT,
+    embedding BLOB,
+    entry BLOB
+);
+CREATE INDEX IF NOT EXISTS semantic_mode ON semantic (mode, id);
+"""
+# Открытые соединения с базами SQLite (по пути к файлу), общие для всех сессий
+_db_pool: Dict[str, sqlite3.Connection] = {}
+# Загруженные истории: (путь к базе, режим) -> (отпечаток файлов базы, сообщения).
+# Повторный вход в режим не перечитывает базу, пока ее файлы не изменились
+_history_memo: Dict[Tuple[str, str], Tuple[Tuple[int, ...], List[Dict[str, Any]]]] = {}
+_HISTORY_MEMO_SIZE = 4
+
+
+def get_db(path: str, schema: str) -> sqlite3.Connection:
+    """Возвращает соединение с базой SQLite из пула; при первом обращении открывает его и создает схему"""
+    conn = _db_pool.get(path)
+    if conn is None:
+        # isolation_level=None: каждая запись фиксируется сразу, транзакции - только явные
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        for pragma in _SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        conn.executescript(schema)
+        _db_pool[path] = conn
+    return conn
+
+
+def db_fingerprint(path: str) -> Tuple[int, ...]:
+    """Отпечаток базы SQLite: время изменения и размер основного файла и журнала WAL"""
+    parts: List[int] = []
+    for name in (path, path + "-wal"):
+        try:
+            st = os.stat(name)
+            parts += [st.st_mtime_ns, st.st_size]
+        except OSError:
+            parts += [0, 0]
+    return tuple(parts)
+
+
+def _remember_history(path: str, mode: str, messages: List[Dict[str, Any]]):
+    """Запоминает историю режима вместе с текущим отпечатком базы"""
+    key = (path, mode)
+    _history_memo.pop(key, None)
+    if len(_history_memo) >= _HISTORY_MEMO_SIZE:
+        _history_memo.pop(next(iter(_history_memo)))
+    _history_memo[key] = (db_fingerprint(path), list(messages))
+
+
+def close_dbs():
+    """Закрывает все соединения с базами SQLite"""
+    while _db_pool:
+        _, conn = _db_pool.popitem()
+        conn.close()
+
+
+class ResponseCache:
+    """Постоянный кэш ответов модели по точному совпадению запроса"""
+    
+    def __init__(self, path: str = CACHE_DB):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = get_db(self.path, _CACHE_SCHEMA)
+            # Записи старше максимального срока жизни уже никогда не будут выданы
+            self._db.execute("DELETE FROM responses WHERE ts < ?", (time.time() - RESPONSE_CACHE_TTL,))
+        except Exception as e:
+            print(f"[Предупреждение: Не удалось открыть кэш ответов: {e}]\n")
+            self._db = None
+    
+    @classmethod
+    def _normalize(cls, value: Any) -> Any:
+        """Нормализует строки запроса: единые переводы строк, без хвостовых пробелов"""
+        if isinstance(value, str):
+            return value.replace("\r\n", "\n").rstrip()
+        if isinstance(value, list):
+            return [cls._normalize(item) for item in value]
+        if isinstance(value, dict):
+            return {key: cls._normalize(item) for key, item in value.items()}
+        return value
+    
+    @classmethod
+    def make_key(cls, model: str, messages: List[Dict[str, Any]], system: Any = None,
+                 temperature: Optional[float] = None, tools: Any = None, thinking: Any = None) -> str:
+        """
+        Вычисляет SHA-256 ключ по всем параметрам, влияющим на ответ.
+        orjson сразу возвращает UTF-8 байты и заметно быстрее json на длинной кириллической истории
+        """
+        payload = cls._normalize({
+            "model": model,
+            "messages": messages,
+            "system": system,
+            "temperature": temperature,
+            "tools": tools,
+            "thinking": thinking
+        })
+        return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    
+    def get(self, key: str, max_age: Optional[float] = RESPONSE_CACHE_TTL) -> Optional[Dict[str, Any]]:
+        """Возвращает запись кэша или None, если её нет или она устарела"""
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute("SELECT ts, entry FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if max_age is not None and time.time() - row[0] > max_age:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            return orjson.loads(row[1])
+        except Exception:
+            return None
+    
+    def set(self, key: str, response: str, model: str, **extra: Any):
+        """Сохраняет ответ вместе с метаданными (модель, время)"""
+        if self._db is None:
+            return
+        timestamp = time.time()
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, ts, entry) VALUES (?, ?, ?)",
+                (key, timestamp, orjson.dumps({
+                    "response": response,
+                    "model": model,
+                    "timestamp": timestamp,
+                    **extra
+                }))
+            )
+        except Exception as e:
+            print(f"[Предупреждение: Не удалось сохранить ответ в кэш: {e}]\n")
+    
+    def close(self):
+        """Отпускает базу кэша; само соединение общее и закрывается в close_dbs"""
+        self._db = None
+
+
+class SemanticCache:
+    """Семантический кэш: переиспользует ответы на близкие по смыслу вопросы"""
+    
+    EMBEDDING_DIM = 384
+    LOG_FILE = os.path.join(CACHE_DIR, "semantic_log.jsonl")
+    
+    def __init__(self, mode: str, threshold: float = SEMANTIC_CACHE_THRESHOLD, path: str = CACHE_DB):
+        self.mode = mode
+        self.threshold = threshold
+        self.path = path
+        # Без numpy семантический кэш отключается
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.enabled = numpy is not None
+        # Эмбеддинг последнего вопроса, вычисленный lookup: (вопрос, эмбеддинг).
+        # Нужен add, если поиск был отменен до того, как вернул результат
+        self._last_embedding: Optional[Tuple[str, Any]] = None
+        self._db: Optional[sqlite3.Connection] = None
+        # Эмбеддинги хранятся одной матрицей (N, 384), нормированной по L2,
+        # поэтому косинусное сходство считается одним матричным умножением
+        self.matrix = None
+        self.queries: List[str] = []
+        self.entries: List[Dict[str, Any]] = []
+        if self.enabled:
+            self.load()
+    
+    def load(self):
+        """Загружает сохраненные эмбеддинги и ответы режима из базы кэша"""
+        import numpy as np
+        
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = get_db(self.path, _CACHE_SCHEMA)
+            rows = self._db.execute(
+                "SELECT query, embedding, entry FROM semantic WHERE mode = ? ORDER BY id", (self.mode,)
+            ).fetchall()
+            row_bytes = self.EMBEDDING_DIM * 4
+            rows = [row for row in rows if len(row[1]) == row_bytes]
+            if rows:
+                self.matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(
+                    len(rows), self.EMBEDDING_DIM
+                )
+                self.queries = [row[0] for row in rows]
+                self.entries = [orjson.loads(row[2]) for row in rows]
+        except Exception as e:
+            print(f"[Предупреждение: Не удалось загрузить семантический кэш: {e}]\n")
+    
+    def _store(self, query: str, embedding: Any, entry: Dict[str, Any]):
+        """Дописывает одну запись в базу вместо перезаписи всего кэша"""
+        import numpy as np
+        
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT INTO semantic (mode, query, embedding, entry) VALUES (?, ?, ?, ?)",
+                (self.mode, query, embedding.astype(np.float32, copy=False).tobytes(), orjson.dumps(entry))
+            )
+        except Exception as e:
+            print(f"[Предупреждение: Не удалось сохранить семантический кэш: {e}]\n")
+    
+    def _get_model(self):
+        """
+        Лениво загружает модель эмбеддингов при первом обращении.
+        Загрузка идет в потоке поиска, пока выводится ответ, поэтому о ней не сообщается
+        """
+        global _semantic_model
+        with _semantic_model_lock:
+            if _semantic_model is None and self.enabled:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError:
+                    print("[Предупреждение: sentence-transformers не установлен, семантический кэш отключен]\n")
+                    self.enabled = False
+                    return None
+                _semantic_model = SentenceTransformer(SEMANTIC_MODEL_NAME)
+        return _semantic_model
+    
+    def encode(self, text: str):
+        """Возвращает нормированный эмбеддинг текста или None, если кэш недоступен"""
+        if not self.enabled:
+            return None
+        import numpy as np
+        
+        try:
+            model = self._get_model()
+            if model is None:
+                return None
+            return model.encode(text, normalize_embeddings=True).astype(np.float32)
+        except Exception as e:
+            print(f"[Предупреждение: Не удалось вычислить эмбеддинг: {e}]\n")
+            self.enabled = False
+            return None
+    
+    def lookup(self, query: str) -> Tuple[Optional[Dict[str, Any]], Any]:
+        """
+        Ищет ближайший сохраненный вопрос.
+        Возвращает (запись или None, эмбеддинг запроса для последующего add)
+        """
+        embedding = self.encode(query)
+        self._last_embedding = (query, embedding)
+        if embedding is None or self.matrix is None or not self.entries:
+            return None, embedding
+        scores = self.matrix @ embedding
+        best = int(scores.argmax())
+        score = float(scores[best])
+        hit = score >= self.threshold
+        self._log(query, best, score, hit)
+        return (self.entries[best] if hit else None), embedding
+    
+    def add(self, query: str, entry: Dict[str, Any], embedding: Any = None):
+        """
+        Добавляет ответ в кэш. Без готового эмбеддинга (модель еще загружается) вопрос не сохраняется:
+        ждать загрузку перед следующим вводом нельзя
+        """
+        if embedding is None and self._last_embedding is not None and self._last_embedding[0] == query:
+            # Отмененный поиск успел вычислить эмбеддинг в своем потоке
+            embedding = self._last_embedding[1]
+        if embedding is None and _semantic_model is not None:
+            embedding = self.encode(query)
+        if embedding is None:
+            return
+        import numpy as np
+        
+        row = embedding.reshape(1, -1)
+        self.matrix = row if self.matrix is None else np.vstack([self.matrix, row])
+        self.queries.append(query)
+        self.entries.append(entry)
+        self._store(query, embedding, entry)
+    
+    def _log(self, query: str, best: int, score: float, hit: bool):
+        """
+        Пишет пары (score, was_correct) для подбора порога.
+        Поле was_correct заполняется при ручной разметке лога
+        """
+        try:
+            with open(self.LOG_FILE, 'ab') as f:
+                f.write(orjson.dumps({
+                    "timestamp": time.time(),
+                    "mode": self.mode,
+                    "query": query,
+                    "matched_query": self.queries[best] if best < len(self.queries) else None,
+                    "score": score,
+                    "hit": hit,
+                    "was_correct": None
+                }) + b"\n")
+        except Exception:
+            pass
+
+
+class RequestThrottle:
+    """
+    Клиентское ограничение частоты запросов к ProxyAPI.
+    Регулирует число одновременных запросов по схеме AIMD и делает паузу,
+    когда по заголовкам rate limit остается меньше 10% лимита.
+    Контекст (async with) занимает слот на все время запроса,
+    а wait_if_throttled вызывается перед каждой попыткой отправки
+    """
+    
+    MAX_CONCURRENCY = 8
+    LOW_REMAINING_RATIO = 0.1
+    # Максимальная пауза перед запросом (в секундах)
+    MAX_WAIT = 60.0
+    # Окно подсчета запросов в минуту (в секундах)
+    WINDOW = 60.0
+    # Заголовки лимитов: (лимит, остаток, время сброса) для OpenAI и Anthropic
+    RATE_LIMIT_HEADERS = [
+        ("x-ratelimit-limit-{}", "x-ratelimit-remaining-{}", "x-ratelimit-reset-{}"),
+        ("anthropic-ratelimit-{}-limit", "anthropic-ratelimit-{}-remaining", "anthropic-ratelimit-{}-reset"),
+    ]
+    
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY, initial_concurrency: float = 1.0):
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(min(initial_concurrency, max_concurrency))
+        self.rpm_limit: Optional[int] = None
+        self._in_flight = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._sent: deque = deque()  # Время отправки запросов за последнюю минуту
+        self._resume_at = 0.0  # Момент (time.monotonic), раньше которого запросы не отправляются
+    
+    async def __aenter__(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.concurrency))
+            self._in_flight += 1
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.on_success()
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+        return False
+    
+    def report_error(self, exc: Exception):
+        """Учитывает ошибку отдельной попытки запроса (заголовки лимитов, 429/5xx)"""
+        status = getattr(exc, "status_code", None)
+        response = getattr(exc, "response", None)
+        if response is not None:
+            self.observe(response.headers)
+        if status == 429 or (status is not None and status >= 500):
+            self.on_error(response.headers.get("retry-after") if response is not None else None)
+    
+    async def wait_if_throttled(self):
+        """Ждет, если исчерпан лимит запросов в минуту или сервер просил паузу"""
+        now = time.monotonic()
+        while self._sent and now - self._sent[0] > self.WINDOW:
+            self._sent.popleft()
+        delay = self._resume_at - now
+        if self.rpm_limit and len(self._sent) >= self.rpm_limit:
+            delay = max(delay, self.WINDOW - (now - self._sent[0]))
+        if delay > 0:
+            delay = min(delay, self.MAX_WAIT)
+            print(f"[Ограничение частоты запросов: пауза {delay:.1f} с]\n")
+            await asyncio.sleep(delay)
+        self._sent.append(time.monotonic())
+    
+    def on_success(self):
+        """Аддитивное увеличение допустимого числа одновременных запросов"""
+        self.concurrency = min(self.max_concurrency, self.concurrency + 0.5)
+    
+    def on_error(self, retry_after: Optional[str] = None):
+        """Мультипликативное уменьшение при 429/5xx и пауза перед следующим запросом"""
+        self.concurrency = max(1.0, self.concurrency * 0.5)
+        delay = self._parse_reset(retry_after) if retry_after else None
+        self._resume_at = max(self._resume_at, time.monotonic() + min(delay or 1.0, self.MAX_WAIT))
+    
+    def observe(self, headers: Any):
+        """Читает заголовки rate limit ответа и планирует паузу при малом остатке"""
+        for limit_name, remaining_name, reset_name in self.RATE_LIMIT_HEADERS:
+            for kind in ("requests", "tokens"):
+                limit = headers.get(limit_name.format(kind))
+                remaining = headers.get(remaining_name.format(kind))
+                if limit is None or remaining is None:
+                    continue
+                try:
+                    limit, remaining = int(limit), int(remaining)
+                except ValueError:
+                    continue
+                if kind == "requests":
+                    self.rpm_limit = limit
+                if remaining < limit * self.LOW_REMAINING_RATIO:
+                    delay = self._parse_reset(headers.get(reset_name.format(kind), ""))
+                    if delay:
+                        self._resume_at = max(self._resume_at, time.monotonic() + min(delay, self.MAX_WAIT))
+    
+    @staticmethod
+    def _parse_reset(value: str) -> Optional[float]:
+        """
+        Переводит время сброса лимита в секунды.
+        OpenAI присылает длительность ("1s", "6m0s", "20ms"), Anthropic - дату RFC 3339,
+        retry-after - число секунд
+        """
+        value = (value or "").strip()
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+        if parts and "".join(number + unit for number, unit in parts) == value:
+            scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+            return sum(float(number) * scale[unit] for number, unit in parts)
+        try:
+            reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        if reset_at.tzinfo is None:
+            reset_at = reset_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (reset_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenWriter:
+    """
+    Буферизованный вывод потокового ответа в терминал.
+    Токены копятся и записываются одним вызовом write/flush не чаще раза в FLUSH_INTERVAL
+    секунд или по накоплении FLUSH_CHARS символов; остаток выводится таймером,
+    чтобы текст не задерживался, если поток токенов приостановился
+    """
+    
+    # Максимальная задержка вывода (в секундах), незаметная для глаза
+    FLUSH_INTERVAL = 0.016
+    FLUSH_CHARS = 256
+    
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._buffer: List[str] = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._timer: Optional[asyncio.TimerHandle] = None
+    
+    def write(self, text: str):
+        """Добавляет текст в буфер и выводит буфер, если подошло время или размер"""
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.FLUSH_CHARS or time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.FLUSH_INTERVAL, self.flush)
+    
+    def flush(self):
+        """Выводит накопленный текст одной записью"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer:
+            self.stream.write("".join(self._buffer))
+            self._buffer.clear()
+            self._size = 0
+        self.stream.flush()
+        self._last_flush = time.monotonic()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        # Выводим остаток и при прерывании потока (Ctrl+C, ошибка API)
+        self.flush()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tokenizer() -> Any:
+    """Лениво загружает токенизатор tiktoken; None, если пакет не установлен или словарь недоступен"""
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Считает токены текста (без tiktoken - оценка по длине в символах)"""
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return len(text) // CHARS_PER_TOKEN
+    return len(tokenizer.encode(text, disallowed_special=()))
+
 
 class ChatSession:
     """Класс для управления сессией чата с сохранением контекста"""
     
-    HISTORY_FILE = "chat_history.json"
+    # История всех режимов хранится в SQLite: одно сообщение - одна строка таблицы messages,
+    # режим последней сессии - в таблице meta
+    HISTORY_DB = "chat_history.db"
+    # Файл истории прежнего формата (один JSON целиком); переносится в базу, если она еще пуста
+    LEGACY_JSON_FILE = "chat_history.json"
+    # Размер истории (в токенах), после которого ранние сообщения сворачиваются
+    COMPACT_THRESHOLD_TOKENS = 8000
+    # Сколько самых ранних сообщений сворачивается за один раз
+    COMPACT_BATCH = 10
+    # Сообщения хода копятся в буфере и записываются в базу одной строкой (пакет JSON),
+    # при этом пакет не превышает SEGMENT_MAX_BYTES
+    SEGMENT_MAX_BYTES = 64 * 1024
+    # Значение role у строки базы, в которой упакованы несколько сообщений
+    SEGMENT_ROLE = "segment"
     
-    def __init__(self, use_web_search: bool = False, mode: str = "openai"):
+    def __init__(self, use_web_search: bool = False, mode: str = "openai", resume: bool = False):
         self.messages: List[Dict[str, Any]] = []
         self.use_web_search = use_web_search
         self.mode = mode  # "openai" или "anthropic"
-        # Загружаем историю из файла
-        self.load_history()
+        # save_history может выполняться в отдельном потоке: не даем ему пересечься с записью сообщений
+        self._save_lock = threading.Lock()
+        # Сообщения, еще не записанные в базу
+        self._buf: List[Dict[str, Any]] = []
+        self._buf_bytes = 0
+        # Фоновая запись истории после ответа (см. schedule_save)
+        self._save_task: Optional[asyncio.Task] = None
+        try:
+            self._db: Optional[sqlite3.Connection] = get_db(self.HISTORY_DB, _HISTORY_SCHEMA)
+        except sqlite3.Error as e:
+            print(f"[Предупреждение: Не удалось открыть базу истории: {e}]\n")
+            self._db = None
+        # Загружаем историю из базы
+        self.load_history(resume=resume)
+        # Загруженная история уже лежит в базе, и переписывать ее при каждом входе в чат незачем
+        stored = bool(self.messages) and self.messages[0].get("role") == "system"
         # Если истории нет, добавляем системный промпт
-        if not self.messages or self.messages[0].get("role") != "system":
+        if not stored:
             self.messages.insert(0, {
                 "role": "system",
                 "content": SYSTEM_PROMPT
             })
+        # Шаблон параметров запроса к OpenAI, общий для всех ходов сессии.
+        # Список сообщений в нем - ссылка на представление истории, а не копия
+        self.openai_request_template: Dict[str, Any] = {"model": OPENAI_MODEL, "temperature": 0.7}
+        self._rebuild_views()
+        if stored:
+            # С --resume последняя сессия могла быть в другом режиме - запоминаем этот
+            self._store_mode()
+        else:
+            # Новая история: прежние сообщения режима в базе заменяются системным промптом
+            self._store_history()
+    
+    def _rebuild_views(self):
+        """Пересобирает представления истории для API после загрузки или очистки"""
+        # Системный промпт всегда первое сообщение истории; отдельной строкой он нужен Anthropic
+        self.system_prompt: str = self.messages[0]["content"]
+        # Для OpenAI история передается как есть (системный промпт - первое сообщение)
+        self._openai_view: List[Dict[str, Any]] = self.messages
+        # Для Anthropic - без системных сообщений; дальше список пополняется вместе с историей
+        self._anthropic_view: List[Dict[str, Any]] = self.messages[self._dialog_start():]
+        # Число токенов каждого сообщения (параллельно self.messages): текст токенизируется один раз,
+        # а не при каждом пересчете бюджета. В сами сообщения счетчик не пишется - они уходят в API как есть
+        self._token_counts: List[int] = [count_tokens(msg["content"]) for msg in self.messages]
+        self._token_count = sum(self._token_counts)
+        self.openai_request_template["messages"] = self._openai_view
+        self._refresh_anthropic_prefix()
+    
+    def _refresh_anthropic_prefix(self):
+        """
+        Собирает системный промпт для Anthropic и ставит метку кэша на последнее сообщение.
+        Вызывается после загрузки, очистки и сокращения истории, когда меняется начало диалога
+        """
+        # Неизменный системный промпт - отдельным блоком с меткой кэша, краткое содержание - после него
+        self._anthropic_system: List[Dict[str, Any]] = [{
+            "type": "text",
+            "text": self.system_prompt,
+            "cache_control": _ANTHROPIC_CACHE_CONTROL
+        }]
+        summary = self._get_summary_message()
+        if summary:
+            self._anthropic_system.append({"type": "text", "text": summary["content"]})
+        self._cache_mark: Optional[Tuple[int, Dict[str, Any]]] = None
+        self._mark_cache_breakpoint()
+    
+    def _mark_cache_breakpoint(self):
+        """
+        Переносит метку кэша Anthropic на последнее сообщение представления: при каждом запросе
+        вся история кэшируется, а следующий запрос читает ее из кэша как неизменный префикс.
+        Сами сообщения истории не изменяются - в представлении помеченное сообщение заменяется копией
+        """
+        view = self._anthropic_view
+        if self._cache_mark is not None:
+            index, original = self._cache_mark
+            view[index] = original
+            self._cache_mark = None
+        if not view or not isinstance(view[-1]["content"], str) or not view[-1]["content"]:
+            return
+        original = view[-1]
+        view[-1] = {
+            "role": original["role"],
+            "content": [{"type": "text", "text": original["content"], "cache_control": _ANTHROPIC_CACHE_CONTROL}]
+        }
+        self._cache_mark = (len(view) - 1, original)
+    
+    def _append(self, message: Dict[str, Any]):
+        """Добавляет сообщение в историю, в представление для Anthropic и в базу"""
+        self.messages.append(message)
+        self._anthropic_view.append(message)
+        self._mark_cache_breakpoint()
+        tokens = count_tokens(message["content"])
+        self._token_counts.append(tokens)
+        self._token_count += tokens
+        self._persist(message)
+    
+    def _persist(self, message: Dict[str, Any]):
+        """Добавляет сообщение в буфер записи; переполненный буфер сразу записывается в базу"""
+        # Буфер может записываться фоновым потоком (schedule_save), поэтому меняется под блокировкой
+        with self._save_lock:
+            self._buf.append(message)
+            self._buf_bytes += len(message["content"].encode("utf-8"))
+            full = self._buf_bytes >= self.SEGMENT_MAX_BYTES
+        if full:
+            self.flush_buffer()
+    
+    def flush_buffer(self) -> bool:
+        """Записывает накопленные сообщения в базу одним INSERT; возвращает False при ошибке записи"""
+        with self._save_lock:
+            if self._db is None:
+                self._buf = []
+                self._buf_bytes = 0
+            if not self._buf:
+                return True
+            role, content = self.pack_segment(self._buf)
+            try:
+                self._db.execute(
+                    "INSERT INTO messages (ts, role, content, mode) VALUES (?, ?, ?, ?)",
+                    (time.time(), role, content, self.mode)
+                )
+            except sqlite3.Error as e:
+                # Сообщения остаются в буфере и уйдут в базу при следующей записи
+                print(f"[Предупреждение: Не удалось сохранить сообщения: {e}]\n")
+                return False
+            self._buf = []
+            self._buf_bytes = 0
+            return True
+    
+    @classmethod
+    def pack_segment(cls, messages: List[Dict[str, Any]]) -> Tuple[str, str]:
+        """Упаковывает сообщения в (role, content) одной строки базы; одно сообщение хранится как есть"""
+        if len(messages) == 1:
+            return messages[0]["role"], messages[0]["content"]
+        return cls.SEGMENT_ROLE, orjson.dumps(messages).decode("utf-8")
+    
+    @classmethod
+    def unpack_segment_body(cls, role: str, content: str) -> List[Dict[str, Any]]:
+        """Распаковывает строку базы в список сообщений (и пакет, и одиночное сообщение)"""
+        if role == cls.SEGMENT_ROLE:
+            return orjson.loads(content)
+        return [{"role": role, "content": content}]
+    
+    def _store_messages(self, mode: str, messages: List[Dict[str, Any]]):
+        """Заменяет в базе историю режима mode одной транзакцией и запоминает режим последней сессии"""
+        now = time.time()
+        with self._save_lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("DELETE FROM messages WHERE mode = ?", (mode,))
+                self._db.executemany(
+                    "INSERT INTO messages (ts, role, content, mode) VALUES (?, ?, ?, ?)",
+                    [(now, msg["role"], msg["content"], mode) for msg in messages]
+                )
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('mode', ?)", (mode,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+    
+    def _store_mode(self):
+        """Запоминает режим последней сессии, не трогая сохраненную историю"""
+        if self._db is None:
+            return
+        try:
+            with self._save_lock:
+                # Тот же режим не перезаписывается: база не меняется, и память истории остается в силе
+                self._db.execute(
+                    "INSERT INTO meta (key, value) VALUES ('mode', ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value WHERE value != excluded.value",
+                    (self.mode,)
+                )
+        except sqlite3.Error as e:
+            print(f"[Предупреждение: Не удалось сохранить историю: {e}]\n")
+    
+    def _store_history(self):
+        """
+        Перезаписывает историю режима в базе текущими сообщениями.
+        Вызывается при старте новой истории, при ее очистке и после сокращения, а не на каждом сообщении
+        """
+        # Буфер не нужен: история записывается целиком
+        with self._save_lock:
+            self._buf = []
+            self._buf_bytes = 0
+        if self._db is None:
+            return
+        try:
+            self._store_messages(self.mode, self.messages)
+        except sqlite3.Error as e:
+            print(f"[Предупреждение: Не удалось сохранить историю: {e}]\n")
+    
+    def _import_legacy_history(self):
+        """Переносит в базу историю из файла прежнего формата (JSON)"""
+        if not os.path.exists(self.LEGACY_JSON_FILE):
+            return
+        with open(self.LEGACY_JSON_FILE, 'rb') as f:
+            history_data = orjson.loads(f.read())
+        mode, messages = history_data.get("mode"), history_data.get("messages", [])
+        if mode and messages:
+            self._store_messages(mode, messages)
     
     def add_user_message(self, content: str):
         """Добавляет сообщение пользователя в историю"""
-        self.messages.append({
+        self._append({
             "role": "user",
             "content": content
         })
     
     def add_assistant_message(self, content: str):
         """Добавляет сообщение ассистента в историю"""
-        self.messages.append({
+        self._append({
             "role": "assistant",
             "content": content
         })
     
     def get_messages_for_openai(self) -> List[Dict[str, str]]:
-        """Возвращает сообщения в формате для OpenAI API"""
-        return [msg for msg in self.messages]
+        """Возвращает сообщения в формате для OpenAI API (без копирования)"""
+        return self._openai_view
     
     def get_messages_for_anthropic(self) -> List[Dict[str, Any]]:
-        """Возвращает сообщения в формате для Anthropic API (без system)"""
-        return [msg for msg in self.messages if msg["role"] != "system"]
+        """
+        Возвращает сообщения в формате для Anthropic API (без system, без копирования).
+        Последнее сообщение несет метку кэша промпта (cache_control)
+        """
+        return self._anthropic_view
     
-    def get_system_prompt(self) -> str:
-        """Возвращает системный промпт"""
-        if self.messages and self.messages[0]["role"] == "system":
-            return self.messages[0]["content"]
-        return SYSTEM_PROMPT
+    def get_system_blocks(self) -> List[Dict[str, Any]]:
+        """Возвращает системный промпт для Anthropic API блоками: с меткой кэша и кратким содержанием"""
+        return self._anthropic_system
     
-    def save_history(self):
-        """Сохраняет историю диалога в файл"""
+    def _dialog_start(self) -> int:
+        """
+        Индекс первого сообщения диалога: системные сообщения (промпт и краткое содержание)
+        стоят только в начале истории, поэтому отделяются срезом, без обхода всего списка
+        """
+        return 2 if self._get_summary_message() else 1
+    
+    def is_first_question(self) -> bool:
+        """
+        Последний вопрос задан без предшествующего диалога (нет ни прошлых ходов, ни краткого содержания):
+        только такой вопрос понятен сам по себе и может переиспользовать ответ семантического кэша
+        """
+        return len(self.messages) == 2
+    
+    def _get_summary_message(self) -> Optional[Dict[str, Any]]:
+        """Возвращает сообщение с кратким содержанием (второе системное сообщение), если оно есть"""
+        if len(self.messages) > 1 and self.messages[1]["role"] == "system":
+            return self.messages[1]
+        return None
+    
+    async def maybe_compact(self, summarize: Callable[[str], Awaitable[str]]):
+        """
+        Сворачивает самые ранние сообщения в краткое содержание, когда история
+        превышает COMPACT_THRESHOLD_TOKENS, чтобы стоимость каждого запроса не росла
+        """
+        if self._token_count <= self.COMPACT_THRESHOLD_TOKENS:
+            return
+        
+        summary = self._get_summary_message()
+        start = self._dialog_start()
+        end = start + self.COMPACT_BATCH
+        # Оставшаяся часть истории должна начинаться с сообщения пользователя
+        while end < len(self.messages) and self.messages[end]["role"] != "user":
+            end += 1
+        if end >= len(self.messages):
+            return
+        
+        parts = [summary["content"]] if summary else []
+        for msg in self.messages[start:end]:
+            speaker = "Пользователь" if msg["role"] == "user" else "Ассистент"
+            parts.append(f"{speaker}: {msg['content']}")
+        
         try:
-            history_data = {
-                "mode": self.mode,
-                "use_web_search": self.use_web_search,
-                "last_updated": datetime.now().isoformat(),
-                "messages": self.messages
-            }
-            with open(self.HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(history_data, f, ensure_ascii=False, indent=2)
+            summary_text = await summarize("\n\n".join(parts))
         except Exception as e:
+            print(f"[Предупреждение: Не удалось сократить историю: {e}]\n")
+            return
+        if not summary_text:
+            return
+        
+        # Изменяем списки на месте: на них ссылаются параметры запросов
+        self.messages[1:end] = [{
+            "role": "system",
+            "content": SUMMARY_PREFIX + summary_text
+        }]
+        # Токенизируется только новое краткое содержание, счетчики остальных сообщений уже известны
+        self._token_counts[1:end] = [count_tokens(self.messages[1]["content"])]
+        self._anthropic_view[:] = self.messages[2:]
+        self._token_count = sum(self._token_counts)
+        self._refresh_anthropic_prefix()
+        self._store_history()
+        print("[Ранняя часть диалога сокращена до краткого содержания]\n")
+    
+    def save_history(self):
+        """
+        Записывает буфер сообщений хода в базу и переносит накопленный журнал WAL
+        в основной файл базы (можно вызывать через asyncio.to_thread)
+        """
+        flushed = self.flush_buffer()
+        if self._db is None:
+            return
+        try:
+            with self._save_lock:
+                self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+                # База теперь совпадает с self.messages: следующий вход в режим возьмет историю из памяти
+                if flushed:
+                    _remember_history(self.HISTORY_DB, self.mode, self.messages)
+        except sqlite3.Error as e:
             print(f"[Предупреждение: Не удалось сохранить историю: {e}]\n")
     
-    def load_history(self):
-        """Загружает историю диалога из файла"""
+    async def schedule_save(self):
+        """
+        Запускает save_history в отдельном потоке и не ждет его:
+        запись на диск идет, пока пользователь набирает следующий вопрос
+        """
+        self._save_task = asyncio.create_task(asyncio.to_thread(self.save_history))
+        # Задача стартует, только когда цикл событий получит управление, а дальше чат блокируется
+        # в input(): уступаем цикл один раз, чтобы запись ушла в поток до приглашения "Вы:"
+        await asyncio.sleep(0)
+    
+    async def wait_saved(self):
+        """Дожидается фоновой записи, запущенной schedule_save, перед следующим изменением истории"""
+        task, self._save_task = self._save_task, None
+        if task is not None:
+            await task
+    
+    def load_history(self, resume: bool = False):
+        """
+        Загружает историю этого режима из базы.
+        Без resume история загружается, только если последняя сессия была в этом же режиме
+        """
+        if self._db is None:
+            return
         try:
-            if os.path.exists(self.HISTORY_FILE):
-                with open(self.HISTORY_FILE, 'r', encoding='utf-8') as f:
-                    history_data = json.load(f)
-                    # Загружаем только если режим совпадает
-                    if history_data.get("mode") == self.mode:
-                        self.messages = history_data.get("messages", [])
-                        if self.messages:
-                            print(f"[Загружена история диалога из предыдущей сессии]\n")
+            if self._db.execute("SELECT 1 FROM meta WHERE key = 'mode'").fetchone() is None:
+                self._import_legacy_history()
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'mode'").fetchone()
+            if resume or (row is not None and row[0] == self.mode):
+                memo = _history_memo.get((self.HISTORY_DB, self.mode))
+                if memo is not None and memo[0] == db_fingerprint(self.HISTORY_DB):
+                    self.messages = list(memo[1])
+                else:
+                    self.messages = [
+                        msg
+                        for role, content in self._db.execute(
+                            "SELECT role, content FROM messages WHERE mode = ? ORDER BY id", (self.mode,)
+                        )
+                        for msg in self.unpack_segment_body(role, content)
+                    ]
+            if self.messages:
+                print(f"[Загружена история диалога из предыдущей сессии]\n")
         except Exception as e:
             print(f"[Предупреждение: Не удалось загрузить историю: {e}]\n")
             self.messages = []
@@ -107,16 +1025,204 @@ class ChatSession:
             "role": "system",
             "content": SYSTEM_PROMPT
         }]
-        if os.path.exists(self.HISTORY_FILE):
+        self._rebuild_views()
+        self._store_history()
+
+# Обработчики событий потока Claude: возвращают (вид, содержимое).
+# Блоки thinking содержат поле .thinking, текстовые - .text, инструменты - .name
+_BLOCK_HANDLERS = {
+    "text": lambda block: ("text", None),
+    "thinking": lambda block: ("thinking", None),
+    "tool_use": lambda block: ("tool", block.name),
+    "server_tool_use": lambda block: ("tool", block.name),
+}
+_DELTA_HANDLERS = {
+    "text_delta": lambda delta: ("text", delta.text),
+    "thinking_delta": lambda delta: ("thinking", delta.thinking),
+}
+# Заголовки разделов при потоковом выводе ответа Claude
+_SECTION_HEADERS = {
+    "thinking": "[Рассуждения модели]:\n\n",
+    "text": "[Окончательный ответ]:\n",
+}
+
+
+def _report_retry(retry_state):
+    """Сообщает пользователю о повторе запроса после временной ошибки"""
+    error = retry_state.outcome.exception()
+    delay = retry_state.next_action.sleep if retry_state.next_action else 0
+    print(f"\n[Временная ошибка API ({type(error).__name__}), повтор через {delay:.1f} с...]\n")
+
+
+def _retry_policy(sdk: ModuleType, connection_errors: bool = True) -> AsyncRetrying:
+    """
+    Политика повторов временных ошибок API: до 4 попыток с экспоненциальной задержкой.
+    sdk - модуль openai или anthropic, по его классам ошибок определяется, что повторять.
+    connection_errors=False - не повторять обрывы соединения: запрос мог дойти до сервера,
+    и повтор неидемпотентного запроса (создания пакета) создал бы дубликат
+    """
+    # Сетевые ошибки SDK оборачивает в APIConnectionError.
+    # Таймауты не повторяются: каждая попытка и так ждет 30 секунд
+    retryable = (sdk.RateLimitError, sdk.InternalServerError) + ((sdk.APIConnectionError,) if connection_errors else ())
+    # Любой ответ 5xx тоже временный: перегрузка Anthropic (529, OverloadedError)
+    # не является подклассом InternalServerError
+    server_error = retry_if_exception(lambda e: isinstance(e, sdk.APIStatusError) and e.status_code >= 500)
+    return AsyncRetrying(
+        stop=stop_after_attempt(4),
+        wait=wait_exponential_jitter(initial=0.5, max=10),
+        retry=(retry_if_exception_type(retryable) | server_error) & retry_if_not_exception_type(sdk.APITimeoutError),
+        before_sleep=_report_retry,
+        reraise=True,
+    )
+
+
+async def _call_with_retry(sdk: ModuleType, call: Callable[..., Awaitable[Any]], *args,
+                           connection_errors: bool = True, **kwargs) -> Any:
+    """Выполняет обычный (не потоковый) запрос к API с повтором временных ошибок"""
+    async for attempt in _retry_policy(sdk, connection_errors):
+        with attempt:
+            result = await call(*args, **kwargs)
+    return result
+
+
+async def _do_chat_call(create: Callable[..., Awaitable[Any]], params: Dict[str, Any],
+                        throttle: RequestThrottle, sdk: ModuleType) -> Any:
+    """
+    Открывает потоковый ответ API с учетом ограничения частоты запросов.
+    sdk - модуль openai или anthropic, по его классам ошибок определяется, что повторять
+    """
+    async for attempt in _retry_policy(sdk):
+        with attempt:
+            await throttle.wait_if_throttled()
             try:
-                os.remove(self.HISTORY_FILE)
-            except:
-                pass
+                stream = await create(**params, stream=True)
+            except sdk.APIStatusError as e:
+                throttle.report_error(e)
+                raise
+            throttle.observe(stream.response.headers)
+    return stream
+
+
+async def _discard_request(task: asyncio.Task):
+    """Отменяет ставший ненужным запрос к API и закрывает уже открытый поток"""
+    task.cancel()
+    try:
+        stream = await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        return
+    except Exception:
+        return
+    await stream.close()
+
+
+async def _lookup_while_requesting(semantic_cache: Optional["SemanticCache"], query: str,
+                                   request_task: asyncio.Task) -> Tuple[Optional[Dict[str, Any]], Any]:
+    """
+    Ищет ответ в семантическом кэше (в отдельном потоке), пока запрос к API уже отправлен.
+    Побеждает то, что завершится первым: при попадании в кэш запрос отменяется,
+    а если поток ответа открылся раньше, поиск отменяется и ответ выводится сразу
+    """
+    if semantic_cache is None:
+        return None, None
+    lookup_task = asyncio.create_task(asyncio.to_thread(semantic_cache.lookup, query))
+    try:
+        await asyncio.wait((lookup_task, request_task), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        lookup_task.cancel()
+        await _discard_request(request_task)
+        raise
+    if not lookup_task.done():
+        # Не ждем эмбеддинг (на первом вопросе - еще и загрузку модели): ответ выводится сразу
+        lookup_task.cancel()
+        return None, None
+    cached, embedding = lookup_task.result()
+    if cached:
+        await _discard_request(request_task)
+    return cached, embedding
+
+
+def _handle_unknown(item: Any) -> Tuple[str, Any]:
+    """Обработчик неизвестных типов блоков (подписи, результаты поиска и т.п.)"""
+    return "unknown", None
+
+
+def _reset_cancellation():
+    """Снимает запрос на отмену текущей задачи после обработки Ctrl+C"""
+    task = asyncio.current_task()
+    # Task.uncancel появился в Python 3.11
+    if task is not None and hasattr(task, "uncancel"):
+        while task.cancelling():
+            task.uncancel()
+
+
+def sdk_httpx(sdk: ModuleType) -> ModuleType:
+    """
+    Возвращает пакет HTTP-клиента, на котором построен SDK: старые версии используют httpx,
+    новые - его форк httpx2, классы клиентов и ошибок которого с httpx несовместимы
+    """
+    base = sdk.DefaultAsyncHttpxClient.__mro__[1]
+    return sys.modules[base.__module__.partition(".")[0]]
+
+
+def create_http_client(sdk: ModuleType) -> Any:
+    """
+    Создает пул соединений для клиента SDK его же фабрикой DefaultAsyncHttpxClient:
+    так пул построен на том же пакете httpx, что и SDK, и сохраняет его настройки по умолчанию.
+    Если установлен aiohttp, запросы идут через транспорт aiohttp (фабрика DefaultAioHttpClient),
+    который лучше держит много параллельных запросов; иначе - HTTP/2
+    """
+    limits = sdk_httpx(sdk).Limits(**HTTP_LIMITS)
+    # DefaultAioHttpClient есть только в новых версиях SDK
+    aiohttp_client = getattr(sdk, "DefaultAioHttpClient", None)
+    if aiohttp_client is not None:
+        try:
+            # Тот же интерфейс AsyncClient, поэтому SDK и обработка ошибок не меняются
+            return aiohttp_client(limits=limits)
+        except RuntimeError:
+            # SDK установлен без extra aiohttp
+            pass
+    try:
+        return sdk.DefaultAsyncHttpxClient(http2=True, limits=limits)
+    except ImportError:
+        # Пакет h2 не установлен - используем HTTP/1.1 с keep-alive
+        return sdk.DefaultAsyncHttpxClient(limits=limits)
+
+
+def create_openai_client(api_key: str) -> "openai.AsyncOpenAI":
+    """Создает клиент OpenAI с собственным пулом соединений"""
+    import openai
+    
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        base_url=OPENAI_BASE_URL,
+        timeout=30.0,  # Таймаут 30 секунд
+        max_retries=0,  # Повторы выполняет _do_chat_call
+        http_client=create_http_client(openai)
+    )
+
+
+def create_anthropic_client(api_key: str) -> "anthropic.AsyncAnthropic":
+    """Создает клиент Anthropic с собственным пулом соединений"""
+    import anthropic
+    
+    return anthropic.AsyncAnthropic(
+        api_key=api_key,
+        base_url=ANTHROPIC_BASE_URL,
+        timeout=30.0,  # Таймаут 30 секунд
+        max_retries=0,  # Повторы выполняет _do_chat_call
+        http_client=create_http_client(anthropic)
+    )
 
 
 def get_api_key() -> str:
-    """Получает API ключ из переменных окружения"""
+    """Получает API ключ из переменных окружения (при необходимости - из файла .env)"""
     api_key = os.getenv("PROXYAPI_KEY")
+    if not api_key:
+        from dotenv import load_dotenv
+        load_dotenv()
+        api_key = os.getenv("PROXYAPI_KEY")
     if not api_key:
         print("Ошибка: API ключ не найден в переменных окружения.")
         print("Пожалуйста, создайте файл .env и добавьте туда PROXYAPI_KEY=ваш_ключ")
@@ -124,112 +1230,176 @@ def get_api_key() -> str:
     return api_key
 
 
-def chat_without_reasoning(api_key: str, use_web_search: bool):
+async def summarize_with_openai(client: "openai.AsyncOpenAI", text: str) -> str:
+    """Сворачивает фрагмент диалога в краткое содержание с помощью GPT-4o mini"""
+    response = await client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        max_tokens=SUMMARY_MAX_TOKENS
+    )
+    return response.choices[0].message.content or ""
+
+
+async def chat_without_reasoning(client: "openai.AsyncOpenAI", use_web_search: bool,
+                                 throttle: RequestThrottle, resume: bool = False):
     """
     Режим без вывода рассуждений (OpenAI GPT-4 mini)
     """
+    import openai
+    
+    httpx = sdk_httpx(openai)  # Ошибки соединения при чтении потока приходят из пакета HTTP-клиента SDK
+    
     print("\n=== Режим без вывода рассуждений (GPT-4 mini) ===")
-    print("Введите 'exit' для выхода из чата\n")
+    print("Введите 'exit' или 'выход' для выхода из чата\n")
     
-    client = openai.OpenAI(
-        api_key=api_key,
-        base_url=OPENAI_BASE_URL,
-        timeout=30.0  # Таймаут 30 секунд
-    )
+    session = ChatSession(use_web_search=use_web_search, mode="openai", resume=resume)
+    
+    # Параметры запроса определяются один раз на сессию: режим веб-поиска до выхода из чата не меняется.
+    # Шаблон сессии ссылается на историю, поэтому на каждом ходу словарь не пересобирается
+    request_params = session.openai_request_template
+    if use_web_search:
+        # Модели с веб-поиском не поддерживают параметр temperature
+        request_params["model"] = OPENAI_SEARCH_MODEL
+        request_params.pop("temperature", None)
+        request_params["web_search_options"] = _WEB_SEARCH_OPTS_OPENAI
+        print("[Веб-поиск включен. Используется модель с поддержкой поиска]\n")
     
-    session = ChatSession(use_web_search=use_web_search, mode="openai")
+    cache_ttl = WEB_SEARCH_CACHE_TTL if use_web_search else RESPONSE_CACHE_TTL
+    
+    # Функция сворачивания длинной истории в краткое содержание
+    summarize = functools.partial(summarize_with_openai, client)
+    response_cache = ResponseCache()
+    # Ответы с веб-поиском зависят от актуальных данных, семантический кэш для них не используется
+    semantic_cache = None if use_web_search else SemanticCache(mode="openai")
+    
+    async def answer_from_cache(entry: Dict[str, Any], label: str):
+        """Выводит ответ из кэша и сохраняет его в историю"""
+        assistant_message = entry["response"]
+        print(f"\n{label}\nАссистент: {assistant_message}\n")
+        session.add_assistant_message(assistant_message)
+        await session.maybe_compact(summarize)
+        await session.schedule_save()
     
     while True:
         try:
             user_input = input("Вы: ").strip()
             
-            if user_input.lower() == "exit":
+            if user_input.casefold() in _EXIT_TOKENS:
                 print("\nВыход из чата...\n")
+                await session.wait_saved()
+                session.save_history()  # Сохраняем историю при выходе
                 break
             
             if not user_input:
                 continue
             
+            # Фоновая запись прошлого хода к этому моменту обычно уже завершена
+            await session.wait_saved()
             # Добавляем сообщение пользователя
             session.add_user_message(user_input)
             
-            # Подготавливаем параметры запроса
-            # Если веб-поиск включен, используем модель с поддержкой веб-поиска
-            model_to_use = OPENAI_MODEL
-            if use_web_search:
-                # Используем модель с поддержкой веб-поиска
-                # Для gpt-4o-mini используем gpt-4o-mini-search-preview
-                model_to_use = "gpt-4o-mini-search-preview"
-            
-            request_params = {
-                "model": model_to_use,
-                "messages": session.get_messages_for_openai(),
-            }
-            
-            # Модели с веб-поиском не поддерживают параметр temperature
-            # Добавляем temperature только для обычных моделей
-            if not use_web_search:
-                request_params["temperature"] = 0.7
-            
-            # Если веб-поиск включен, добавляем параметр web_search_options
-            # Согласно документации ProxyAPI, для Chat Completions API используется web_search_options
-            # с моделями gpt-4o-search-preview или gpt-4o-mini-search-preview
-            if use_web_search:
-                request_params["web_search_options"] = {
-                    "search_context_size": "medium",  # low, medium (по умолчанию), high
-                    "user_location": {
-                        "type": "approximate",
-                        "approximate": {
-                            "country": "RU",
-                            "city": "Moscow",
-                            "region": "Moscow"
-                        }
-                    }
-                }
-                print("\n[Веб-поиск включен. Используется модель с поддержкой поиска]\n")
-            
-            # Отправляем запрос
-            response = client.chat.completions.create(**request_params)
+            # Проверяем кэш ответов: при совпадении запроса обходимся без обращения к API
+            cache_key = ResponseCache.make_key(
+                model=request_params["model"],
+                messages=request_params["messages"],
+                temperature=request_params.get("temperature"),
+                tools=request_params.get("web_search_options")
+            )
+            cached = response_cache.get(
+                cache_key,
+                max_age=cache_ttl
+            )
+            if cached:
+                await answer_from_cache(cached, "[Ответ из кэша]")
+                continue
             
-            # Обрабатываем ответ
-            message = response.choices[0].message
+            # Отправляем запрос в потоковом режиме и выводим токены по мере поступления
+            async with throttle:
+                request_task = asyncio.create_task(
+                    _do_chat_call(client.chat.completions.create, request_params, throttle, openai)
+                )
+                # Пока запрос к API в пути, ищем похожий вопрос в семантическом кэше.
+                # Уточнения вроде "а почему?" без контекста диалога сравнивать бессмысленно,
+                # поэтому кэш используется только для первого вопроса диалога
+                turn_cache = semantic_cache if session.is_first_question() else None
+                cached, query_embedding = await _lookup_while_requesting(turn_cache, user_input, request_task)
+                if cached:
+                    await answer_from_cache(cached, "[Ответ из семантического кэша]")
+                    continue
+                stream = await request_task
+                
+                answer_parts = []
+                used_tools = False
+                # Токены выводятся через буфер, а не отдельной записью в терминал на каждый
+                with TokenWriter() as out:
+                    async with stream:
+                        async for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta
+                            
+                            # Если использовался веб-поиск, выводим информацию
+                            # Для OpenAI формат tool_calls может быть разным
+                            if delta.tool_calls:
+                                used_tools = True
+                                for tool_call in delta.tool_calls:
+                                    # Имя берется одним выражением: из function.name, из name или из словаря
+                                    tool_name = (
+                                        getattr(getattr(tool_call, "function", None), "name", None)
+                                        or getattr(tool_call, "name", None)
+                                        or (tool_call.get("function", {}).get("name") or tool_call.get("name")
+                                            if isinstance(tool_call, dict) else None)
+                                    )
+                                    if tool_name == "web_search":
+                                        out.flush()
+                                        print(f"\n[Модель выполняет веб-поиск...]\n")
+                            
+                            if delta.content:
+                                if not answer_parts:
+                                    out.write("\nАссистент: ")
+                                answer_parts.append(delta.content)
+                                out.write(delta.content)
             
-            # Если использовался веб-поиск, выводим информацию
-            # Для OpenAI формат tool_calls может быть разным
-            if hasattr(message, 'tool_calls') and message.tool_calls:
-                for tool_call in message.tool_calls:
-                    tool_name = None
-                    if hasattr(tool_call, 'function') and hasattr(tool_call.function, 'name'):
-                        tool_name = tool_call.function.name
-                    elif hasattr(tool_call, 'name'):
-                        tool_name = tool_call.name
-                    elif isinstance(tool_call, dict):
-                        tool_name = tool_call.get('function', {}).get('name') or tool_call.get('name')
-                    
-                    if tool_name == "web_search":
-                        print(f"\n[Модель выполняет веб-поиск...]\n")
+            if answer_parts:
+                sys.stdout.write("\n\n")
+                sys.stdout.flush()
             
             # Получаем ответ
-            assistant_message = message.content
+            assistant_message = "".join(answer_parts) or None
             
-            # Если ответ None, возможно модель использует tool_calls
-            if assistant_message is None and hasattr(message, 'tool_calls') and message.tool_calls:
+            # Если ответа нет, возможно модель использует tool_calls
+            if assistant_message is None and used_tools:
                 # В этом случае нужно сделать дополнительный запрос с результатами tool_calls
                 # Но для упрощения просто выводим информацию
                 print(f"\n[Модель использует инструменты для получения информации...]\n")
                 assistant_message = "[Ответ будет получен после выполнения инструментов]"
             
-            # Выводим ответ
-            if assistant_message:
-                print(f"\nАссистент: {assistant_message}\n")
-            
             # Сохраняем ответ в историю
             if assistant_message:
                 session.add_assistant_message(assistant_message)
-                session.save_history()  # Сохраняем историю после каждого ответа
+                await session.maybe_compact(summarize)
+                # Сохраняем историю после каждого ответа в фоне, не задерживая следующий ввод
+                await session.schedule_save()
+                # Ответы-заглушки при использовании инструментов не кэшируем
+                if answer_parts:
+                    response_cache.set(cache_key, assistant_message, model=request_params["model"])
+                    if turn_cache is not None:
+                        # Эмбеддинг, если поиск был отменен, вычисляется уже загруженной моделью - в отдельном потоке
+                        await asyncio.to_thread(
+                            turn_cache.add,
+                            user_input,
+                            {"response": assistant_message, "model": request_params["model"]},
+                            query_embedding
+                        )
             
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # Ctrl+C во время ожидания ответа приходит в корутину как отмена задачи
+            _reset_cancellation()
             print("\n\nВыход из чата...\n")
+            await session.wait_saved()
             session.save_history()  # Сохраняем историю при выходе
             break
         except openai.APITimeoutError as e:
@@ -240,39 +1410,178 @@ def chat_without_reasoning(api_key: str, use_web_search: bool):
             print(f"\n[Ошибка API: {e.status_code if hasattr(e, 'status_code') else 'Unknown'}]\n")
             print(f"Детали: {e}\n")
             continue
-        except Exception as e:
-            print(f"\n[Ошибка: {e}]\n")
-            import traceback
-            traceback.print_exc()
+        except httpx.HTTPError as e:
+            print(f"\n[Ошибка соединения: {e}]\n")
             continue
+    
+    response_cache.close()
+
 
+def _load_saved_anthropic_model() -> Optional[str]:
+    """Читает модель Claude, сохраненную прошлым запуском"""
+    try:
+        with open(ANTHROPIC_MODEL_FILE, encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
 
-def chat_with_reasoning(api_key: str, use_web_search: bool):
+
+def _save_anthropic_model(model: str):
+    """Запоминает подтвержденную модель Claude для следующих запусков"""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(ANTHROPIC_MODEL_FILE, 'w', encoding='utf-8') as f:
+            f.write(model)
+    except OSError:
+        pass
+
+
+async def _probe_anthropic_model(client: "anthropic.AsyncAnthropic", model: str):
+    """Минимальный запрос (1 токен): исключение означает, что модель недоступна"""
+    await client.messages.create(
+        model=model,
+        max_tokens=1,
+        messages=[{"role": "user", "content": "ping"}]
+    )
+
+
+async def _model_rejected(client: "anthropic.AsyncAnthropic", model: str) -> Optional[bool]:
+    """
+    Проверяет модель минимальным запросом: True - модель не поддерживается, False - работает,
+    None - ошибка не говорит о модели (сеть, ключ)
+    """
+    import anthropic
+    
+    try:
+        await _probe_anthropic_model(client, model)
+    except (anthropic.BadRequestError, anthropic.NotFoundError):
+        return True
+    except anthropic.APIError:
+        return None
+    return False
+
+
+async def resolve_anthropic_model(client: "anthropic.AsyncAnthropic", exclude: Optional[str] = None) -> Optional[str]:
+    """
+    Определяет поддерживаемую модель Claude минимальными запросами (1 токен).
+    Сначала отдельно проверяется основная ANTHROPIC_MODEL, затем запасная модель из прошлого запуска,
+    и только если обе не работают - остальные кандидаты параллельно: выбирается первая
+    по приоритету рабочая модель, ожидание - одно время ответа, а не сумма.
+    Результат запоминается до конца работы приложения и в файле ANTHROPIC_MODEL_FILE
+    """
+    global _resolved_anthropic_model
+    if _resolved_anthropic_model:
+        return _resolved_anthropic_model
+    import anthropic
+    
+    candidates = [ANTHROPIC_MODEL] + [m for m in ANTHROPIC_ALTERNATIVE_MODELS if m != ANTHROPIC_MODEL]
+    candidates = [m for m in candidates if m != exclude]
+    saved = _load_saved_anthropic_model()
+    # Основная модель проверяется первой всегда, чтобы сохраненная запасная не вытеснила ее навсегда.
+    # Обычно первая проверка успешна, и запросы к остальным кандидатам не отправляются
+    for model in dict.fromkeys(m for m in (ANTHROPIC_MODEL, saved) if m in candidates):
+        rejected = await _model_rejected(client, model)
+        if rejected is None:
+            # Решение откладываем до первого сообщения
+            return None
+        if not rejected:
+            _resolved_anthropic_model = model
+            if model != saved:
+                _save_anthropic_model(model)
+            return model
+        candidates.remove(model)
+    
+    tasks = [asyncio.create_task(_probe_anthropic_model(client, m)) for m in candidates]
+    try:
+        for model, task in zip(candidates, tasks):
+            try:
+                await task
+            except (anthropic.BadRequestError, anthropic.NotFoundError):
+                # Модель не поддерживается - берем следующую по приоритету
+                continue
+            except anthropic.APIError:
+                return None
+            _resolved_anthropic_model = model
+            _save_anthropic_model(model)
+            return model
+        return None
+    finally:
+        # Ответы менее приоритетных моделей уже не нужны
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def summarize_with_anthropic(client: "anthropic.AsyncAnthropic", text: str) -> str:
+    """Сворачивает фрагмент диалога в краткое содержание с помощью Claude (без рассуждений)"""
+    response = await client.messages.create(
+        model=_resolved_anthropic_model or ANTHROPIC_MODEL,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        system=SUMMARY_PROMPT,
+        messages=[{"role": "user", "content": text}]
+    )
+    return "\n".join(block.text for block in response.content if block.type == "text")
+
+
+async def chat_with_reasoning(client: "anthropic.AsyncAnthropic", use_web_search: bool,
+                              throttle: RequestThrottle, resume: bool = False):
     """
     Режим с выводом рассуждений (Anthropic Claude Sonnet 4.5)
     """
+    global _resolved_anthropic_model
+    import anthropic
+    
+    httpx = sdk_httpx(anthropic)  # Ошибки соединения при чтении потока приходят из пакета HTTP-клиента SDK
+    
     print("\n=== Режим с выводом рассуждений (Claude Sonnet 4.5) ===")
-    print("Введите 'exit' для выхода из чата\n")
+    print("Введите 'exit' или 'выход' для выхода из чата\n")
     
-    client = anthropic.Anthropic(
-        api_key=api_key,
-        base_url=ANTHROPIC_BASE_URL,
-        timeout=30.0  # Таймаут 30 секунд
-    )
+    # Ответы с веб-поиском зависят от актуальных данных, семантический кэш для них не используется.
+    # Семантический кэш загружается с диска в отдельном потоке, пока идет проверка модели
+    semantic_task = None if use_web_search else asyncio.create_task(asyncio.to_thread(SemanticCache, "anthropic"))
+    
+    # Заранее определяем поддерживаемую модель, чтобы первое сообщение не тратилось на перебор
+    model = await resolve_anthropic_model(client)
+    if model and model != ANTHROPIC_MODEL:
+        print(f"[Используется модель: {model}]\n")
     
-    session = ChatSession(use_web_search=use_web_search, mode="anthropic")
+    session = ChatSession(use_web_search=use_web_search, mode="anthropic", resume=resume)
+    # Функция сворачивания длинной истории в краткое содержание
+    summarize = functools.partial(summarize_with_anthropic, client)
+    response_cache = ResponseCache()
+    semantic_cache = await semantic_task if semantic_task else None
+    
+    async def answer_from_cache(entry: Dict[str, Any], label: str):
+        """Выводит ответ (и рассуждения) из кэша и сохраняет его в историю"""
+        final_answer = entry["response"]
+        # Весь вывод собирается одной строкой и пишется в терминал одной записью
+        parts = [f"\n{label}\n"]
+        if entry.get("reasoning"):
+            parts.append("\n[Рассуждения модели]:\n\n")
+            parts.append("\n".join(entry["reasoning"]))
+            parts.append("\n\n")
+        parts.append(f"\n[Окончательный ответ]:\n{final_answer}\n\n")
+        sys.stdout.write("".join(parts))
+        sys.stdout.flush()
+        session.add_assistant_message(final_answer)
+        await session.maybe_compact(summarize)
+        await session.schedule_save()
     
     while True:
         try:
             user_input = input("Вы: ").strip()
             
-            if user_input.lower() == "exit":
+            if user_input.casefold() in _EXIT_TOKENS:
                 print("\nВыход из чата...\n")
+                await session.wait_saved()
+                session.save_history()  # Сохраняем историю при выходе
                 break
             
             if not user_input:
                 continue
             
+            # Фоновая запись прошлого хода к этому моменту обычно уже завершена
+            await session.wait_saved()
             # Добавляем сообщение пользователя
             session.add_user_message(user_input)
             
@@ -281,9 +1590,9 @@ def chat_with_reasoning(api_key: str, use_web_search: bool):
             # Для режима с рассуждениями включаем параметр thinking
             # Согласно документации Anthropic: https://docs.anthropic.com/en/docs/build-with-claude/extended-thinking
             request_params = {
-                "model": ANTHROPIC_MODEL,
+                "model": _resolved_anthropic_model or ANTHROPIC_MODEL,
                 "max_tokens": 4096,
-                "system": session.get_system_prompt(),
+                "system": session.get_system_blocks(),
                 "messages": session.get_messages_for_anthropic(),
                 "thinking": {
                     "type": "enabled",
@@ -293,139 +1602,122 @@ def chat_with_reasoning(api_key: str, use_web_search: bool):
             
             # Если веб-поиск включен, добавляем инструмент
             if use_web_search:
-                request_params["tools"] = [{
-                    "type": "web_search_20250305",
-                    "name": "web_search",
-                    "max_uses": 5
-                }]
-            
-            # Отправляем запрос
-            try:
-                response = client.messages.create(**request_params)
-            except anthropic.BadRequestError as e:
-                # Если модель не поддерживается, пробуем альтернативные варианты
-                if "Model not supported" in str(e) or "model" in str(e).lower():
-                    print(f"\n[Предупреждение: Модель {ANTHROPIC_MODEL} не поддерживается, пробуем альтернативные варианты...]\n")
-                    # Пробуем другие варианты названий моделей
-                    alternative_models = [
-                        "claude-sonnet-4-5-20250929",
-                        "claude-sonnet-4-5-20250514",
-                        "claude-sonnet-4-5",
-                        "claude-3-7-sonnet-20250219",
-                        "claude-3-5-sonnet-20241022"
-                    ]
-                    response = None
-                    for alt_model in alternative_models:
-                        try:
-                            request_params["model"] = alt_model
-                            response = client.messages.create(**request_params)
-                            print(f"[Используется модель: {alt_model}]\n")
-                            break
-                        except:
-                            continue
-                    if response is None:
-                        raise Exception("Не удалось найти поддерживаемую модель Claude. Проверьте доступные модели в документации ProxyAPI.")
-                else:
-                    raise
+                request_params["tools"] = _ANTHROPIC_WEB_TOOL
             
-            # Обрабатываем ответ с рассуждениями
-            # В Claude Sonnet 4.5 рассуждения могут быть в отдельных блоках
-            reasoning_blocks = []
-            text_blocks = []
-            tool_use_blocks = []
+            # Проверяем кэш ответов: при совпадении запроса обходимся без обращения к API
+            cache_key = ResponseCache.make_key(
+                model=request_params["model"],
+                messages=request_params["messages"],
+                system=request_params["system"],
+                tools=request_params.get("tools"),
+                thinking=request_params["thinking"]
+            )
+            cached = response_cache.get(
+                cache_key,
+                max_age=WEB_SEARCH_CACHE_TTL if use_web_search else RESPONSE_CACHE_TTL
+            )
+            if cached:
+                await answer_from_cache(cached, "[Ответ из кэша]")
+                continue
             
-            # Проходим по всем блокам контента
-            for content_block in response.content:
-                block_type = getattr(content_block, 'type', None)
+            # Отправляем запрос в потоковом режиме
+            async with throttle:
+                request_task = asyncio.create_task(
+                    _do_chat_call(client.messages.create, request_params, throttle, anthropic)
+                )
+                # Пока запрос к API в пути, ищем похожий вопрос в семантическом кэше.
+                # Уточнения вроде "а почему?" без контекста диалога сравнивать бессмысленно,
+                # поэтому кэш используется только для первого вопроса диалога
+                turn_cache = semantic_cache if session.is_first_question() else None
+                cached, query_embedding = await _lookup_while_requesting(turn_cache, user_input, request_task)
+                if cached:
+                    await answer_from_cache(cached, "[Ответ из семантического кэша]")
+                    continue
+                try:
+                    stream = await request_task
+                except anthropic.BadRequestError as e:
+                    # Слово "model" бывает и в других ошибках (например, превышен контекст модели),
+                    # поэтому модель меняется, только если минимальный запрос к ней тоже отклонен
+                    if "model" not in str(e).lower() or not await _model_rejected(client, request_params["model"]):
+                        raise
+                    print(f"\n[Предупреждение: Модель {request_params['model']} не поддерживается, пробуем альтернативные варианты...]\n")
+                    # Проверяем остальные варианты названий моделей параллельно дешевыми запросами
+                    # и повторяем основной запрос только с подтвержденной моделью
+                    _resolved_anthropic_model = None
+                    alt_model = await resolve_anthropic_model(client, exclude=request_params["model"])
+                    if alt_model is None:
+                        print("\n[Ошибка: Не удалось найти поддерживаемую модель Claude. Проверьте доступные модели в документации ProxyAPI.]\n")
+                        continue
+                    request_params["model"] = alt_model
+                    stream = await _do_chat_call(client.messages.create, request_params, throttle, anthropic)
+                    print(f"[Используется модель: {alt_model}]\n")
                 
-                # Проверяем тип блока
-                if block_type == "text":
-                    # Это текстовый ответ
-                    text_content = getattr(content_block, 'text', '')
-                    text_blocks.append(text_content)
-                elif block_type == "thinking":
-                    # Это блок рассуждений (thinking mode)
-                    reasoning_text = ""
-                    if hasattr(content_block, 'text'):
-                        reasoning_text = content_block.text
-                    elif hasattr(content_block, 'content'):
-                        reasoning_text = str(content_block.content)
-                    else:
-                        # Пробуем получить текст из других атрибутов
-                        for attr in ['thinking', 'reasoning', 'thought', 'content']:
-                            if hasattr(content_block, attr):
-                                value = getattr(content_block, attr)
-                                if isinstance(value, str):
-                                    reasoning_text = value
-                                elif hasattr(value, 'text'):
-                                    reasoning_text = value.text
-                                break
-                    
-                    if reasoning_text:
-                        reasoning_blocks.append(reasoning_text)
-                elif block_type == "tool_use":
-                    # Это использование инструмента (например, веб-поиск)
-                    tool_name = getattr(content_block, 'name', '')
-                    if tool_name == "web_search":
-                        print(f"\n[Модель выполняет веб-поиск...]\n")
-                    tool_use_blocks.append(content_block)
-                else:
-                    # Проверяем другие возможные типы блоков
-                    # Рассуждения могут быть в блоке с другими названиями
-                    block_type_str = str(block_type).lower()
-                    
-                    # Проверяем различные варианты названий блоков рассуждений
-                    if any(keyword in block_type_str for keyword in ['reasoning', 'thought']):
-                        # Это блок рассуждений
-                        reasoning_text = ""
-                        if hasattr(content_block, 'text'):
-                            reasoning_text = content_block.text
-                        elif hasattr(content_block, 'content'):
-                            reasoning_text = str(content_block.content)
-                        else:
-                            # Пробуем получить текст из других атрибутов
-                            for attr in ['thinking', 'reasoning', 'thought', 'content']:
-                                if hasattr(content_block, attr):
-                                    value = getattr(content_block, attr)
-                                    if isinstance(value, str):
-                                        reasoning_text = value
-                                    elif hasattr(value, 'text'):
-                                        reasoning_text = value.text
-                                    break
-                        
-                        if reasoning_text:
-                            reasoning_blocks.append(reasoning_text)
+                # Обрабатываем поток событий: рассуждения (thinking_delta) и ответ (text_delta)
+                # приходят отдельными событиями и выводятся по мере поступления
+                buckets = {"thinking": [], "text": []}
+                section = None  # Раздел, который сейчас выводится: "thinking" или "text"
+                
+                # Токены выводятся через буфер, а не отдельной записью в терминал на каждый
+                with TokenWriter() as out:
+                    async with stream:
+                        async for event in stream:
+                            if event.type == "content_block_start":
+                                kind, payload = _BLOCK_HANDLERS.get(event.content_block.type, _handle_unknown)(event.content_block)
+                                if kind == "tool":
+                                    # Это использование инструмента (например, веб-поиск)
+                                    if payload == "web_search":
+                                        out.flush()
+                                        print(f"\n[Модель выполняет веб-поиск...]\n")
+                                elif kind in buckets:
+                                    if kind == "text" and section == "text":
+                                        out.write("\n")
+                                    buckets[kind].append([])
+                            elif event.type == "content_block_delta":
+                                kind, payload = _DELTA_HANDLERS.get(event.delta.type, _handle_unknown)(event.delta)
+                                if kind not in buckets:
+                                    continue
+                                if section != kind:
+                                    out.write(("\n\n" if section else "\n") + _SECTION_HEADERS[kind])
+                                    section = kind
+                                if not buckets[kind]:
+                                    buckets[kind].append([])
+                                buckets[kind][-1].append(payload)
+                                out.write(payload)
             
-            # Выводим рассуждения, если они есть
-            if reasoning_blocks:
-                print(f"\n[Рассуждения модели]:\n")
-                for reasoning in reasoning_blocks:
-                    print(reasoning)
-                print()
+            if section is not None:
+                sys.stdout.write("\n\n")
+                sys.stdout.flush()
             
-            # Выводим финальный ответ
-            final_answer = ""
-            if text_blocks:
-                final_answer = "\n".join(text_blocks)
-                print(f"\n[Окончательный ответ]:\n{final_answer}\n")
-            else:
-                # Если структура ответа отличается, выводим весь текст
-                full_text = ""
-                for content_block in response.content:
-                    if hasattr(content_block, 'text'):
-                        full_text += content_block.text + "\n"
-                if full_text:
-                    final_answer = full_text.strip()
-                    print(f"\n[Окончательный ответ]:\n{final_answer}\n")
+            reasoning_blocks = ["".join(parts) for parts in buckets["thinking"] if parts]
+            final_answer = "\n".join("".join(parts) for parts in buckets["text"] if parts)
             
             # Сохраняем ответ в историю
             # Для Anthropic нужно сохранить весь ответ
             if final_answer:
                 session.add_assistant_message(final_answer)
-                session.save_history()  # Сохраняем историю после каждого ответа
+                await session.maybe_compact(summarize)
+                # Сохраняем историю после каждого ответа в фоне, не задерживая следующий ввод
+                await session.schedule_save()
+                response_cache.set(
+                    cache_key,
+                    final_answer,
+                    model=request_params["model"],
+                    reasoning=reasoning_blocks
+                )
+                if turn_cache is not None:
+                    # Эмбеддинг, если поиск был отменен, вычисляется уже загруженной моделью - в отдельном потоке
+                    await asyncio.to_thread(
+                        turn_cache.add,
+                        user_input,
+                        {"response": final_answer, "model": request_params["model"], "reasoning": reasoning_blocks},
+                        query_embedding
+                    )
             
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # Ctrl+C во время ожидания ответа приходит в корутину как отмена задачи
+            _reset_cancellation()
             print("\n\nВыход из чата...\n")
+            await session.wait_saved()
             session.save_history()  # Сохраняем историю при выходе
             break
         except anthropic.APITimeoutError as e:
@@ -436,23 +1728,325 @@ def chat_with_reasoning(api_key: str, use_web_search: bool):
             print(f"\n[Ошибка API: {e.status_code if hasattr(e, 'status_code') else 'Unknown'}]\n")
             print(f"Детали: {e}\n")
             continue
-        except Exception as e:
-            print(f"\n[Ошибка: {e}\n")
-            import traceback
-            traceback.print_exc()
+        except httpx.HTTPError as e:
+            print(f"\n[Ошибка соединения: {e}]\n")
             continue
+    
+    response_cache.close()
+
+
+def read_batch_prompts(path: str) -> List[Tuple[str, str]]:
+    """
+    Читает вопросы пакетного режима из JSONL: в каждой строке объект {"id": ..., "prompt": ...}
+    (id необязателен) или просто строка с вопросом. Возвращает список (id, вопрос)
+    """
+    prompts: List[Tuple[str, str]] = []
+    seen = set()
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = orjson.loads(line)
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not isinstance(item, dict) or not isinstance(item.get("prompt"), str) or not item["prompt"].strip():
+                raise ValueError(f"строка {number}: нет поля prompt")
+            custom_id = str(item.get("id", f"line-{number}"))
+            if not _BATCH_ID_RE.match(custom_id) or custom_id in seen:
+                raise ValueError(f"строка {number}: id должен быть уникальным (до 64 символов: латиница, цифры, _ и -)")
+            seen.add(custom_id)
+            prompts.append((custom_id, item["prompt"].strip()))
+    return prompts
+
+
+def _openai_batch_params(prompt: str) -> Dict[str, Any]:
+    """Параметры запроса к OpenAI для одного вопроса пакетного режима"""
+    return {
+        "model": OPENAI_MODEL,
+        "temperature": 0.7,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }
+
+
+def _anthropic_batch_params(prompt: str, model: str) -> Dict[str, Any]:
+    """Параметры запроса к Claude для одного вопроса пакетного режима (те же, что у chat_with_reasoning)"""
+    return {
+        "model": model,
+        "max_tokens": 4096,
+        "system": SYSTEM_PROMPT,
+        "messages": [{"role": "user", "content": prompt}],
+        "thinking": {"type": "enabled", "budget_tokens": 1024}
+    }
+
+
+async def _wait_for_batch(batch: Any, retrieve: Callable[[str], Awaitable[Any]],
+                          is_done: Callable[[Any], bool], progress: Callable[[Any], str]) -> Any:
+    """Опрашивает пакет с экспоненциально растущей паузой, пока он не завершится"""
+    delay = BATCH_POLL_INITIAL
+    try:
+        while not is_done(batch):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX)
+            batch = await retrieve(batch.id)
+            print(f"[Пакет {batch.id}: {progress(batch)}]")
+    except asyncio.CancelledError:
+        print(f"\n[Ожидание прервано; пакет {batch.id} продолжит выполняться на сервере]")
+        raise
+    return batch
+
+
+def _report_unfinished_batch(batch_id: str, mode: str):
+    """Подсказывает, как получить ответы уже оплаченного пакета после сбоя или прерывания"""
+    print(f"[Ответы пакета {batch_id} можно получить позже: "
+          f"python main.py --batch <FILE> --mode {mode} --batch-id {batch_id}]")
+
+
+async def batch_with_openai(client: "openai.AsyncOpenAI", prompts: List[Tuple[str, str]],
+                            batch_id: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Выполняет вопросы через OpenAI Batch API; возвращает результаты по id.
+    С batch_id новый пакет не создается: ожидаются ответы отправленного ранее
+    """
+    import openai
+    
+    if batch_id:
+        batch = await _call_with_retry(openai, client.batches.retrieve, batch_id)
+        print(f"[Пакет {batch.id}: {batch.status}]")
+    else:
+        lines = [
+            orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": _openai_batch_params(prompt)
+            })
+            for custom_id, prompt in prompts
+        ]
+        batch_file = await _call_with_retry(
+            openai, client.files.create, file=("batch.jsonl", b"\n".join(lines) + b"\n"), purpose="batch"
+        )
+        batch = await _call_with_retry(
+            openai, client.batches.create,
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            connection_errors=False
+        )
+        print(f"[Пакет {batch.id} отправлен, вопросов: {len(prompts)}]")
+    try:
+        batch = await _wait_for_batch(
+            batch,
+            functools.partial(_call_with_retry, openai, client.batches.retrieve),
+            lambda b: b.status in ("completed", "failed", "expired", "cancelled"),
+            lambda b: f"{b.status}, готово {b.request_counts.completed + b.request_counts.failed}/{b.request_counts.total}"
+            if b.request_counts else b.status
+        )
+        if batch.status != "completed":
+            print(f"[Предупреждение: Пакет завершился со статусом {batch.status}]")
+        
+        results: Dict[str, Dict[str, Any]] = {}
+        # Успешные ответы и ошибки приходят отдельными файлами в одном формате строк
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await _call_with_retry(openai, client.files.content, file_id)
+            for line in (await content.aread()).splitlines():
+                if not line.strip():
+                    continue
+                item = orjson.loads(line)
+                response = item.get("response") or {}
+                body = response.get("body") or {}
+                if response.get("status_code") == 200 and body.get("choices"):
+                    results[item["custom_id"]] = {"response": body["choices"][0]["message"].get("content") or ""}
+                else:
+                    error = item.get("error") or body.get("error") or {}
+                    results[item["custom_id"]] = {"error": error.get("message") or f"HTTP {response.get('status_code')}"}
+    except BaseException:
+        _report_unfinished_batch(batch.id, "openai")
+        raise
+    return results
+
+
+async def batch_with_anthropic(client: "anthropic.AsyncAnthropic", prompts: List[Tuple[str, str]],
+                               batch_id: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Выполняет вопросы через Anthropic Message Batches (с рассуждениями); возвращает результаты по id.
+    С batch_id новый пакет не создается: ожидаются ответы отправленного ранее
+    """
+    import anthropic
+    
+    if batch_id:
+        batch = await _call_with_retry(anthropic, client.messages.batches.retrieve, batch_id)
+        print(f"[Пакет {batch.id}: {batch.processing_status}]")
+    else:
+        model = await resolve_anthropic_model(client) or ANTHROPIC_MODEL
+        batch = await _call_with_retry(
+            anthropic, client.messages.batches.create,
+            requests=[
+                {"custom_id": custom_id, "params": _anthropic_batch_params(prompt, model)}
+                for custom_id, prompt in prompts
+            ],
+            connection_errors=False
+        )
+        print(f"[Пакет {batch.id} отправлен, вопросов: {len(prompts)}, модель: {model}]")
+    try:
+        batch = await _wait_for_batch(
+            batch,
+            functools.partial(_call_with_retry, anthropic, client.messages.batches.retrieve),
+            lambda b: b.processing_status == "ended",
+            lambda b: f"{b.processing_status}, в обработке {b.request_counts.processing}/{len(prompts)}"
+        )
+        
+        results: Dict[str, Dict[str, Any]] = {}
+        async for entry in await _call_with_retry(anthropic, client.messages.batches.results, batch.id):
+            result = entry.result
+            if result.type == "succeeded":
+                blocks = result.message.content
+                results[entry.custom_id] = {
+                    "response": "\n".join(block.text for block in blocks if block.type == "text"),
+                    "reasoning": [block.thinking for block in blocks if block.type == "thinking"]
+                }
+            else:
+                # errored содержит описание ошибки, canceled и expired - только тип
+                error = getattr(getattr(getattr(result, "error", None), "error", None), "message", None)
+                results[entry.custom_id] = {"error": error or result.type}
+    except BaseException:
+        _report_unfinished_batch(batch.id, "anthropic")
+        raise
+    return results
+
+
+async def _answer_with_openai(client: "openai.AsyncOpenAI", throttle: RequestThrottle, prompt: str) -> Dict[str, Any]:
+    """Отвечает на один вопрос обычным запросом к OpenAI (для --concurrency)"""
+    import openai
+    
+    async with throttle:
+        stream = await _do_chat_call(client.chat.completions.create, _openai_batch_params(prompt), throttle, openai)
+        parts = []
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+    return {"response": "".join(parts)}
+
+
+async def _answer_with_anthropic(client: "anthropic.AsyncAnthropic", model: str, throttle: RequestThrottle,
+                                 prompt: str) -> Dict[str, Any]:
+    """Отвечает на один вопрос обычным запросом к Claude (для --concurrency)"""
+    import anthropic
+    
+    buckets: Dict[str, List[List[str]]] = {"thinking": [], "text": []}
+    async with throttle:
+        stream = await _do_chat_call(client.messages.create, _anthropic_batch_params(prompt, model), throttle, anthropic)
+        async with stream:
+            async for event in stream:
+                if event.type == "content_block_start":
+                    kind, _ = _BLOCK_HANDLERS.get(event.content_block.type, _handle_unknown)(event.content_block)
+                    if kind in buckets:
+                        buckets[kind].append([])
+                elif event.type == "content_block_delta":
+                    kind, payload = _DELTA_HANDLERS.get(event.delta.type, _handle_unknown)(event.delta)
+                    if kind in buckets:
+                        if not buckets[kind]:
+                            buckets[kind].append([])
+                        buckets[kind][-1].append(payload)
+    return {
+        "response": "\n".join("".join(parts) for parts in buckets["text"] if parts),
+        "reasoning": ["".join(parts) for parts in buckets["thinking"] if parts]
+    }
+
+
+async def answer_concurrently(prompts: List[Tuple[str, str]],
+                              answer: Callable[[RequestThrottle, str], Awaitable[Dict[str, Any]]],
+                              concurrency: int, sdk: ModuleType) -> Dict[str, Dict[str, Any]]:
+    """
+    Отправляет все вопросы сразу обычными запросами: одновременно в пути не больше concurrency.
+    RequestThrottle работает как семафор и уменьшает параллельность при 429/5xx,
+    а повторы после временных ошибок выполняет _do_chat_call
+    """
+    httpx = sdk_httpx(sdk)
+    throttle = RequestThrottle(max_concurrency=concurrency, initial_concurrency=concurrency)
+    done = 0
+    
+    async def one(custom_id: str, prompt: str) -> Tuple[str, Dict[str, Any]]:
+        nonlocal done
+        try:
+            result = await answer(throttle, prompt)
+        except (sdk.APIError, httpx.HTTPError) as e:
+            result = {"error": str(e)}
+        done += 1
+        print(f"[Готово {done}/{len(prompts)}]")
+        return custom_id, result
+    
+    return dict(await asyncio.gather(*(one(custom_id, prompt) for custom_id, prompt in prompts)))
+
+
+async def run_batch(input_path: str, output_path: Optional[str], mode: str, concurrency: Optional[int] = None,
+                    batch_id: Optional[str] = None):
+    """
+    Пакетный режим: отправляет все вопросы из input_path одним пакетом Batch API
+    (вдвое дешевле обычных запросов, выполнение - до 24 часов)
+    и записывает ответы в output_path (JSONL, в порядке вопросов).
+    С concurrency вопросы сразу отправляются обычными запросами, до concurrency одновременно.
+    С batch_id ожидаются ответы пакета, отправленного ранее с тем же файлом вопросов
+    """
+    try:
+        prompts = read_batch_prompts(input_path)
+    except (OSError, ValueError) as e:
+        print(f"[Ошибка: Не удалось прочитать файл вопросов: {e}]")
+        sys.exit(1)
+    if not prompts:
+        print("[Ошибка: В файле нет вопросов]")
+        sys.exit(1)
+    output_path = output_path or os.path.splitext(input_path)[0] + ".results.jsonl"
+    
+    api_key = get_api_key()
+    if mode == "anthropic":
+        import anthropic as sdk
+    else:
+        import openai as sdk
+    client = None
+    try:
+        if mode == "anthropic":
+            client = create_anthropic_client(api_key)
+            if concurrency:
+                model = await resolve_anthropic_model(client) or ANTHROPIC_MODEL
+                answer = functools.partial(_answer_with_anthropic, client, model)
+                results = await answer_concurrently(prompts, answer, concurrency, sdk)
+            else:
+                results = await batch_with_anthropic(client, prompts, batch_id)
+        else:
+            client = create_openai_client(api_key)
+            if concurrency:
+                answer = functools.partial(_answer_with_openai, client)
+                results = await answer_concurrently(prompts, answer, concurrency, sdk)
+            else:
+                results = await batch_with_openai(client, prompts, batch_id)
+    except (sdk.APIError, sdk_httpx(sdk).HTTPError) as e:
+        print(f"\n[Ошибка API: {e}]\n")
+        sys.exit(1)
+    finally:
+        if client is not None:
+            await client.close()
+    
+    with open(output_path, 'wb') as f:
+        for custom_id, prompt in prompts:
+            result = results.get(custom_id, {"error": "нет результата"})
+            f.write(orjson.dumps({"id": custom_id, "prompt": prompt, **result}) + b"\n")
+    failed = sum(1 for custom_id, _ in prompts if "response" not in results.get(custom_id, {}))
+    print(f"[Готово: ответы записаны в {output_path}; ошибок: {failed} из {len(prompts)}]")
 
 
 def ask_web_search() -> bool:
     """Спрашивает пользователя, использовать ли веб-поиск"""
     while True:
-        choice = input("Использовать интернет поиск? (да/нет): ").strip().lower()
-        if choice in ["да", "д", "yes", "y"]:
-            return True
-        elif choice in ["нет", "н", "no", "n"]:
-            return False
-        else:
-            print("Пожалуйста, введите 'да' или 'нет'")
+        choice = _YES_NO.get(input("Использовать интернет поиск? (да/нет): ").strip().casefold())
+        if choice is not None:
+            return choice
+        print("Пожалуйста, введите 'да' или 'нет'")
 
 
 def show_menu():
@@ -466,8 +2060,11 @@ def show_menu():
     print("="*50)
 
 
-def main():
-    """Главная функция приложения"""
+async def main(resume: bool = False):
+    """
+    Главная функция приложения.
+    resume - восстанавливать историю чатов из журналов последних сессий
+    """
     print("\n" + "="*70)
     print("CLI Text AI Agent - Консольный ассистент для работы с нейросетями")
     print("="*70)
@@ -484,41 +2081,151 @@ def main():
         print(f"[✗] Ошибка при загрузке API ключа: {e}")
         sys.exit(1)
     
-    while True:
-        try:
-            show_menu()
-            choice = input("\nВыберите режим: ").strip()
-            
-            if choice == "0":
-                print("\nДо свидания!")
-                break
-            elif choice == "1":
-                print("\n[Режим: OpenAI GPT-4o mini]")
-                use_web_search = ask_web_search()
-                if use_web_search:
-                    print("[Веб-поиск: включен]")
-                else:
-                    print("[Веб-поиск: выключен]")
-                chat_without_reasoning(api_key, use_web_search)
-            elif choice == "2":
-                print("\n[Режим: Anthropic Claude Sonnet 4.5 с рассуждениями]")
-                use_web_search = ask_web_search()
-                if use_web_search:
-                    print("[Веб-поиск: включен]")
+    # Клиенты API (каждый со своим пулом соединений) создаются при первом входе в чат
+    # и переиспользуются всеми чатами за время работы приложения
+    openai_client = None
+    anthropic_client = None
+    # Общее ограничение частоты запросов для всех режимов
+    throttle = RequestThrottle()
+    
+    try:
+        while True:
+            try:
+                show_menu()
+                choice = input("\nВыберите режим: ").strip()
+                
+                if choice == "0":
+                    print("\nДо свидания!")
+                    break
+                elif choice == "1":
+                    print("\n[Режим: OpenAI GPT-4o mini]")
+                    use_web_search = ask_web_search()
+                    if use_web_search:
+                        print("[Веб-поиск: включен]")
+                    else:
+                        print("[Веб-поиск: выключен]")
+                    if openai_client is None:
+                        openai_client = create_openai_client(api_key)
+                    await chat_without_reasoning(openai_client, use_web_search, throttle, resume)
+                elif choice == "2":
+                    print("\n[Режим: Anthropic Claude Sonnet 4.5 с рассуждениями]")
+                    use_web_search = ask_web_search()
+                    if use_web_search:
+                        print("[Веб-поиск: включен]")
+                    else:
+                        print("[Веб-поиск: выключен]")
+                    if anthropic_client is None:
+                        anthropic_client = create_anthropic_client(api_key)
+                    await chat_with_reasoning(anthropic_client, use_web_search, throttle, resume)
                 else:
-                    print("[Веб-поиск: выключен]")
-                chat_with_reasoning(api_key, use_web_search)
-            else:
-                print("\nНеверный выбор. Пожалуйста, выберите 0, 1 или 2.\n")
+                    print("\nНеверный выбор. Пожалуйста, выберите 0, 1 или 2.\n")
                 
-        except KeyboardInterrupt:
-            print("\n\nДо свидания!")
-            break
-        except Exception as e:
-            print(f"\nОшибка: {e}\n")
-            import traceback
-            traceback.print_exc()
+            except KeyboardInterrupt:
+                print("\n\nДо свидания!")
+                break
+            except Exception as e:
+                print(f"\nОшибка: {e}\n")
+                log.debug("Ошибка в главном цикле", exc_info=True)
+
+    finally:
+        # Закрытие клиента закрывает и его пул соединений
+        for client in (openai_client, anthropic_client):
+            if client is not None:
+                await client.close()
+        close_dbs()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="CLI приложение для работы с нейросетями через ProxyAPI")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="продолжить последнюю сессию каждого режима, даже если после нее использовался другой режим"
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="выводить трассировку непредвиденных ошибок (то же, что CLI_LOG=DEBUG)"
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="пакетный режим: отправить вопросы из JSONL-файла через Batch API (вдвое дешевле, ответ - до 24 часов)"
+    )
+    parser.add_argument(
+        "--batch-output",
+        metavar="FILE",
+        help="файл для ответов пакетного режима (по умолчанию <FILE>.results.jsonl)"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("openai", "anthropic"),
+        help="модель пакетного режима: openai (GPT-4o mini, по умолчанию) или anthropic (Claude с рассуждениями)"
+    )
+    parser.add_argument(
+        "--batch-id",
+        metavar="ID",
+        help="с --batch: не отправлять новый пакет, а дождаться ответов отправленного ранее (id из вывода приложения)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        metavar="N",
+        help="с --batch: отправить вопросы сразу обычными запросами, до N одновременно (без скидки Batch API)"
+    )
+    args = parser.parse_args(argv)
+    # Параметры пакетного режима без --batch не действуют - сообщаем об этом, а не молча игнорируем
+    if not args.batch:
+        for option, value in (("--batch-output", args.batch_output), ("--mode", args.mode),
+                              ("--batch-id", args.batch_id), ("--concurrency", args.concurrency)):
+            if value is not None:
+                parser.error(f"{option} используется только вместе с --batch")
+    if args.batch_id and args.concurrency is not None:
+        parser.error("--batch-id нельзя использовать вместе с --concurrency")
+    if args.concurrency is not None and args.concurrency < 1:
+        parser.error("--concurrency должно быть не меньше 1")
+    args.mode = args.mode or "openai"
+    return args
+
+
+def run():
+    """
+    Запускает асинхронный main в собственном цикле событий.
+    Ctrl+C во время ввода приходит в корутину как KeyboardInterrupt,
+    а во время ожидания ответа API - как отмена задачи (asyncio.CancelledError),
+    поэтому в обоих случаях чат корректно сохраняет историю и возвращается в меню
+    """
+    args = parse_args()
+    # Уровень задается только журналу приложения, чтобы не включать отладочный вывод httpx и SDK
+    logging.basicConfig(format="[%(levelname)s] %(message)s")
+    try:
+        log.setLevel("DEBUG" if args.verbose else os.getenv("CLI_LOG", "WARNING").upper())
+    except ValueError:
+        log.setLevel(logging.WARNING)
+    if args.batch:
+        coro = run_batch(args.batch, args.batch_output, args.mode, args.concurrency, args.batch_id)
+    else:
+        coro = main(resume=args.resume)
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(coro)
+        while True:
+            try:
+                loop.run_until_complete(task)
+                break
+            except KeyboardInterrupt:
+                if task.done():
+                    print("\n\nДо свидания!")
+                    break
+                task.cancel()
+            except asyncio.CancelledError:
+                # Отмена пришла вне чата - просто завершаем работу
+                print("\n\nДо свидания!")
+                break
+    finally:
+        loop.close()
 
 
 if __name__ == "__main__":
-    main()
+    run()
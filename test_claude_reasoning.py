@@ -5,7 +5,6 @@
 """
 
 import os
-import json
 from dotenv import load_dotenv
 import anthropic
 
@@ -70,134 +69,63 @@ def test_claude_reasoning():
         print("ПОЛНЫЙ JSON ОТВЕТ ОТ API:")
         print("="*70)
         
-        # Функция для безопасной сериализации значений
-        def safe_serialize(value):
-            """Преобразует значение в JSON-сериализуемый формат"""
-            if value is None:
-                return None
-            if isinstance(value, (str, int, float, bool)):
-                return value
-            if isinstance(value, (list, tuple)):
-                return [safe_serialize(item) for item in value]
-            if isinstance(value, dict):
-                return {k: safe_serialize(v) for k, v in value.items()}
-            # Для объектов Pydantic и других объектов
-            if hasattr(value, 'model_dump'):
-                try:
-                    return value.model_dump()
-                except:
-                    pass
-            if hasattr(value, 'dict'):
-                try:
-                    return value.dict()
-                except:
-                    pass
-            # Пробуем преобразовать в строку
-            try:
-                return str(value)
-            except:
-                return None
-        
-        # Преобразуем ответ в словарь для красивого вывода
-        response_dict = {
-            "id": str(response.id) if hasattr(response, 'id') else None,
-            "type": str(response.type) if hasattr(response, 'type') else None,
-            "role": str(response.role) if hasattr(response, 'role') else None,
-            "content": [],
-            "model": str(response.model) if hasattr(response, 'model') else None,
-            "stop_reason": str(response.stop_reason) if hasattr(response, 'stop_reason') else None,
-            "stop_sequence": str(response.stop_sequence) if hasattr(response, 'stop_sequence') else None,
-        }
-        
-        # Добавляем usage, если есть
-        if hasattr(response, 'usage') and response.usage:
-            response_dict["usage"] = {
-                "input_tokens": response.usage.input_tokens if hasattr(response.usage, 'input_tokens') else None,
-                "output_tokens": response.usage.output_tokens if hasattr(response.usage, 'output_tokens') else None
-            }
-        
-        # Обрабатываем content блоки
-        for i, content_block in enumerate(response.content):
-            block_dict = {
-                "index": i,
-                "type": str(content_block.type) if hasattr(content_block, 'type') else "unknown",
-            }
-            
-            # Добавляем специфичные поля в зависимости от типа блока
-            if hasattr(content_block, 'text'):
-                block_dict["text"] = content_block.text
-            
-            if hasattr(content_block, 'name'):
-                block_dict["name"] = content_block.name
-            
-            if hasattr(content_block, 'input'):
-                block_dict["input"] = safe_serialize(content_block.input)
-            
-            # Проверяем только основные атрибуты, которые точно есть
-            important_attrs = ['id', 'text', 'name', 'input', 'type']
-            for attr in important_attrs:
-                if hasattr(content_block, attr) and attr not in block_dict:
-                    try:
-                        value = getattr(content_block, attr)
-                        if value is not None and not callable(value):
-                            # Пропускаем Pydantic-специфичные атрибуты
-                            if not isinstance(value, type) and not attr.startswith('model_'):
-                                block_dict[attr] = safe_serialize(value)
-                    except:
-                        pass
-            
-            response_dict["content"].append(block_dict)
-        
-        # Выводим в красивом JSON формате
-        print(json.dumps(response_dict, indent=2, ensure_ascii=False))
+        # Ответ SDK - pydantic-модель: сериализуем ее встроенным сериализатором одним вызовом,
+        # без обхода атрибутов каждого блока
+        print(response.model_dump_json(indent=2))
         print()
         print("="*70)
         print("АНАЛИЗ СТРУКТУРЫ ОТВЕТА:")
         print("="*70)
         
+        # Один раз превращаем блоки в обычные словари: и анализ структуры, и разбор рассуждений
+        # работают с известными полями схемы, без обхода dir() и getattr для каждого блока
+        blocks = response.model_dump()["content"]
+        
         # Анализируем структуру ответа
-        print(f"Количество блоков в content: {len(response.content)}")
+        print(f"Количество блоков в content: {len(blocks)}")
         print()
         
-        for i, content_block in enumerate(response.content):
+        for i, block in enumerate(blocks):
             print(f"Блок #{i+1}:")
-            print(f"  Тип: {content_block.type}")
+            print(f"  Тип: {block['type']}")
             
-            if hasattr(content_block, 'text'):
-                text = content_block.text
+            if "text" in block:
+                text = block["text"]
                 print(f"  Текст (первые 200 символов): {text[:200]}...")
             
-            # Выводим все атрибуты блока
-            print(f"  Все атрибуты блока:")
-            for attr in dir(content_block):
-                if not attr.startswith('_') and not callable(getattr(content_block, attr, None)):
-                    try:
-                        value = getattr(content_block, attr)
-                        if not callable(value):
-                            value_str = str(value)
-                            if len(value_str) > 100:
-                                value_str = value_str[:100] + "..."
-                            print(f"    {attr}: {value_str}")
-                    except:
-                        pass
+            # Выводим все поля блока
+            print(f"  Все поля блока:")
+            for field, value in block.items():
+                value_str = str(value)
+                if len(value_str) > 100:
+                    value_str = value_str[:100] + "..."
+                print(f"    {field}: {value_str}")
             print()
         
         print("="*70)
         print("ОБРАБОТКА РАССУЖДЕНИЙ:")
         print("="*70)
         
-        # Ищем рассуждения
-        reasoning_found = False
-        for content_block in response.content:
-            block_type = str(content_block.type).lower()
-            if 'reasoning' in block_type:
-                reasoning_found = True
-                print("✓ Найден блок рассуждений!")
-                if hasattr(content_block, 'text'):
-                    print(f"Рассуждения: {content_block.text[:500]}...")
-                break
+        # Тип блока -> (вид содержимого, содержимое); схема SDK гарантирует поле thinking у ThinkingBlock
+        handlers = {
+            "text": lambda block: ("text", block["text"]),
+            "thinking": lambda block: ("reasoning", block["thinking"]),
+        }
+        collected = {"reasoning": [], "text": []}
+        for block in blocks:
+            handler = handlers.get(block["type"])
+            if handler is not None:
+                kind, value = handler(block)
+                collected[kind].append(value)
+        reasoning_blocks = collected["reasoning"]
+        text_blocks = collected["text"]
         
-        if not reasoning_found:
+        if reasoning_blocks:
+            print("✓ Найден блок рассуждений!")
+            print(f"Рассуждения: {reasoning_blocks[0][:500]}...")
+            if text_blocks:
+                print(f"Ответ: {text_blocks[0][:200]}...")
+        else:
             print("✗ Блок рассуждений не найден в ответе")
             print("Проверьте структуру ответа выше")
         